@@ -25,4 +25,11 @@ fi
 
 #python manage.py fill_db
 
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]
+then
+    # metric files of the previous run of this container would be summed up with the new ones
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    find "$PROMETHEUS_MULTIPROC_DIR" -mindepth 1 -delete
+fi
+
 exec "$@"
\ No newline at end of file
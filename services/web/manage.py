@@ -1,45 +1,105 @@
+import click
 from flask.cli import FlaskGroup
 import xml.etree.ElementTree as ET
 import os
-from project import app, db, PatientPseudo, PredictivePseudo, SamplePseudo, modify_predictive_number
-import json
+from project import app, db, PatientPseudo, PredictivePseudo, SamplePseudo, KEY_COLUMNS, pseudo_rows, \
+    pseudonym_cache
+from project.benchmark import BENCHMARKS, SIZES, database_is_empty, run_benchmarks
+from project.bulk_import import batched, insert_new_rows, iter_json_records
+from project.run_index import build_run_index as _build_run_index
+from project.predictive_number import backfill_predictive_index
+from project.schema import DuplicateKeysError, migrate_schema
 import re
+from collections import Counter
 
 
 cli = FlaskGroup(app)
 
 
 @cli.command("create_db")
-def create_db():
-    db.drop_all()
-    db.create_all()
-    db.session.commit()
+@click.option("--drop", is_flag=True, help="Drop all tables first, deleting all data")
+def create_db(drop):
+    if drop:
+        db.drop_all()
+    _print_changes(migrate_schema())
+    _backfill()
 
 
-def _load_data_from_file(file_name, list_name):
-    with open(file_name) as f:
-        data_list = json.load(f)[list_name]
+@cli.command("migrate_db")
+@click.option("--dedupe", is_flag=True, help="Delete duplicate rows (keeping the oldest) blocking unique indexes")
+@click.option("--renormalize", is_flag=True, help="Normalize the predictive numbers of all rows again")
+def migrate_db(dedupe, renormalize):
+    try:
+        _print_changes(migrate_schema(dedupe))
+    except DuplicateKeysError as e:
+        raise click.ClickException(str(e))
+    _backfill(renormalize)
 
-    return data_list
 
+def _print_changes(changes):
+    for change in changes:
+        print(change)
+    if not changes:
+        print("Database schema is up to date")
 
-@cli.command("fill_db")
-def fill_db():
 
-    patients = _load_data_from_file("/pseudo_tables/patients.json", "patients")
-    predictives = _load_data_from_file("/pseudo_tables/predictive.json", "predictive")
-    samples = _load_data_from_file("/pseudo_tables/samples.json", "samples")
+def _backfill(recompute=False):
+    updated = backfill_predictive_index(app.config["BULK_INSERT_BATCH_SIZE"], recompute)
+    if updated:
+        print(f"Normalized predictive numbers of {updated} rows")
+
 
-    for patient in patients:
-        db.session.add(PatientPseudo(patient["patient_ID"], patient["patient_pseudo_ID"]))
+# column -> JSON field of the exported pseudonymization tables
+_FILE_FIELDS = {
+    PatientPseudo: {"patient_id": "patient_ID", "patient_pseudo_id": "patient_pseudo_ID"},
+    PredictivePseudo: {"predictive_id": "predictive_number", "predictive_pseudo_id": "pseudo_number"},
+    SamplePseudo: {"sample_id": "sample_ID", "sample_pseudo_id": "pseudo_sample_ID"},
+}
 
-    for predictive in predictives:
-        db.session.add(PredictivePseudo(predictive["predictive_number"], modify_predictive_number(predictive["predictive_number"]), predictive["pseudo_number"]))
 
-    for sample in samples:
-        db.session.add(SamplePseudo(sample["sample_ID"], sample["pseudo_sample_ID"]))
+def _load_data_from_file(model, file_name, list_name):
+    """Streams the records of an exported table into the database in batches, skipping known records"""
+    counts = Counter()
+    for batch in batched(iter_json_records(file_name, list_name), app.config["BULK_INSERT_BATCH_SIZE"]):
+        rows = pseudo_rows(model, batch, _FILE_FIELDS[model])
+        counts.update(insert_new_rows(model, KEY_COLUMNS[model], rows))
+        db.session.commit()
+    print(f"{file_name}: {dict(counts)}")
 
-    db.session.commit()
+
+@cli.command("fill_db")
+def fill_db():
+    _load_data_from_file(PatientPseudo, "/pseudo_tables/patients.json", "patients")
+    _load_data_from_file(PredictivePseudo, "/pseudo_tables/predictive.json", "predictive")
+    _load_data_from_file(SamplePseudo, "/pseudo_tables/samples.json", "samples")
+    # cached "not found" answers may be outdated now
+    pseudonym_cache.clear()
+
+
+@cli.command("build_run_index")
+def build_run_index():
+    stats = _build_run_index(app.config["RUNS_FOLDER"])
+    print(f"Indexed {stats['indexed_samples']} samples from {app.config['RUNS_FOLDER']}: {stats}")
+
+
+@cli.command("benchmark")
+@click.option("--size", "sizes", multiple=True, type=click.Choice(list(SIZES)), default=["small"], show_default=True,
+              help="Size of the generated data, repeat for several sizes")
+@click.option("--only", multiple=True, type=click.Choice(BENCHMARKS), help="Run only these benchmarks")
+@click.option("--repeat", default=3, show_default=True, help="Runs of every benchmark")
+@click.option("--keep", is_flag=True, help="Keep the generated runs and BBM exports")
+def benchmark(sizes, only, repeat, keep):
+    """Times search, enrichment and retrieval on synthetic data, needs an empty scratch database
+    (e.g. DATABASE_URL=sqlite:////tmp/benchmark.sqlite)"""
+    if not database_is_empty():
+        raise click.ClickException("The database holds data, run the benchmark against an empty scratch database")
+    migrate_schema()
+    results = run_benchmarks(sizes, repeat, only or BENCHMARKS, keep)
+
+    print(f"{'benchmark':<28}{'size':<8}{'items':>8}{'best [s]':>12}{'median [s]':>12}{'per item [ms]':>15}")
+    for result in results:
+        print(f"{result['benchmark']:<28}{result['size']:<8}{result['items']:>8}{result['best_seconds']:>12.4f}"
+              f"{result['median_seconds']:>12.4f}{1000 * result['median_seconds'] / result['items']:>15.3f}")
 
 
 if __name__ == "__main__":
@@ -1,154 +1,52 @@
-import re
+import json
+import queue
 import uuid
 from typing import Dict, List, Any
 
-from flask import jsonify, Response, send_from_directory, request, render_template, session
+from flask import jsonify, Response, send_from_directory, request, render_template, session, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST
 from werkzeug.utils import secure_filename
 import os
-import pandas as pd
 from .app import db, app
-from .tasks import copy_multiple_samples_task, copy_multiple_runs_task
+from .bbm import is_supported_file
+from .bulk_import import CREATED, DUPLICATE, INVALID, batched, insert_new_rows
+from .copy_engine import LINK_MODES
+from .job_events import TERMINAL_STATUSES, job_state_key
+from .job_hub import job_event_hub
+from .job_registry import claim_destinations, in_flight_job, release_destinations
+from .metrics import FIND_FILE_SECONDS, latest_metrics
+from .models import PatientPseudo, PredictivePseudo, SamplePseudo
+from .tasks import copy_multiple_samples_task, copy_multiple_runs_task, enrich_bbm_file_task
+from .predictive_number import normalize, normalize_many
+from .pseudo_cache import PseudonymCache
 from .redis_client import redis_client
-from .utils import threaded_copy
+from .run_index import find_unindexed_samples, lookup_sample_paths, run_index_is_empty
+from .run_search import ListingCache, RunSearch
+from .search_store import SearchResultStore
 
 ALLOWED_EXTENSIONS = {'csv', 'xlsx'}
 
-BBM_parts = {
-    "": ["1", "2", "3", "4", "5", "53", "54", "55", "56"],
-    "s": ["K", "L", "PD", "S", "SD", "T"],
-    "b": ["7", "PR"],
-    "d": ["gD", "PK"]
-}
-
-
-class PatientPseudo(db.Model):
-    __tablename__ = "patient_pseudonymization"
-    id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.String(128))
-    patient_pseudo_id = db.Column(db.String(128))
-
-    def __init__(self, patient_id, patient_pseudo_id):
-        self.patient_id = patient_id
-        self.patient_pseudo_id = patient_pseudo_id
-
-    @property
-    def serialize(self):
-        return {
-            "ID": self.id,
-            "patient_ID": self.patient_id,
-            "patient_pseudo_ID": self.patient_pseudo_id
-        }
-
-
-class PredictivePseudo(db.Model):
-    __tablename__ = "predictive_pseudonymization"
-    id = db.Column(db.Integer, primary_key=True)
-    predictive_id = db.Column(db.String(128))
-    predictive_id_unified = db.Column(db.String(128))
-    predictive_pseudo_id = db.Column(db.String(128))
-
-    def __init__(self, predictive_id, predictive_id_unified, predictive_pseudo_id):
-        self.predictive_id = predictive_id
-        self.predictive_id_unified = predictive_id_unified
-        self.predictive_pseudo_id = predictive_pseudo_id
-
-    @property
-    def serialize(self):
-        return {
-            "predictive_ID": self.predictive_id,
-            "predictive_ID_unified": self.predictive_id_unified,
-            "predictive_pseudo_ID": self.predictive_pseudo_id
-        }
-
-
-class SamplePseudo(db.Model):
-    __tablename__ = "sample_pseudonymization"
-    id = db.Column(db.Integer, primary_key=True)
-    sample_id = db.Column(db.String(128))
-    sample_pseudo_id = db.Column(db.String(128))
-
-    def __init__(self, sample_id, sample_pseudo_id):
-        self.sample_id = sample_id
-        self.sample_pseudo_id = sample_pseudo_id
-
-    @property
-    def serialize(self):
-        return {
-            "id": self.id,
-            "sample_ID": self.sample_id,
-            "sample_pseudo_ID": self.sample_pseudo_id
-        }
+pseudonym_cache = PseudonymCache(redis_client, app.config["PSEUDO_CACHE_MAX_ENTRIES"],
+                                 app.config["PSEUDO_CACHE_TTL_SECONDS"], app.config["PSEUDO_CACHE_LOCAL_TTL_SECONDS"])
+run_search = RunSearch(app.config["RUN_SEARCH_WORKERS"],
+                       ListingCache(app.config["RUN_LISTING_CACHE_SECONDS"], app.config["RUN_LISTING_CACHE_MAX_ENTRIES"]))
+search_results = SearchResultStore(redis_client, app.config["SEARCH_RESULT_TTL_SECONDS"])
 
 
 def modify_predictive_number(pred_number):
-
-    # matching 2022-1234 ([whole_year]-[number])
-    if re.match(r"^20[1-2][\d]-[\d]{1,4}", pred_number):
-        year, id = pred_number.split("-", 1)
-        return f"{year}_{id}"
-
-    # matching 22-1234 ([year]-[number]) etc.
-    if re.match(r"^[1-2][\d]\-[\d]{1,4}", pred_number):
-        year, id = pred_number.split("-", 1)
-        return f"20{year}_{id}"
-
-    # matching 1245-22 ([number]-[year]) etc.
-    if re.match(r"^[\d]{1,4}\-[1-2][\d]", pred_number):
-        id, year = pred_number.split("-", 1)
-        return f"20{year}_{id}"
-
-    # matching 22_1234 ([year]_[number]) etc.
-    if re.match(r"^[1-2][\d]_[\d]{1,4}", pred_number):
-        year, id = pred_number.split("_", 1)
-        return f"20{year}_{id}"
-
-    return pred_number
-
-
-def _add_sample_id_to_excel(df, type_of_df):
-    sample_ids = []
-    row_val = [column for column in df.columns if "prohláš" in column and "číslo" in column][0]
-
-    for i, row in df.iterrows():
-        material = row["materiál"].split("/")[0]
-        biobank_part = [key for key, val in BBM_parts.items() if material in val]
-        sample_id = f'BBM{biobank_part[0]}:20{str(row[row_val]).replace("/", ":")}:{material}'
-        sample_ids.append(sample_id)
-
-    df["sample_id"] = sample_ids
-
-    return df
-
-
-def _check_if_sample_has_sequencing(df):
-    has_seq = [db.session.execute(db.Select(SamplePseudo).filter_by(sample_id=sample_id)).one_or_none() is not None for sample_id in df["sample_id"].tolist()]
-    df["has sequencing"] = has_seq
-    return df
+    """Unified <year>_<number><suffix> form of a predictive number, see predictive_number.RULES"""
+    return normalize(pred_number).unified
 
 
 def _look_if_pred_number_has_data(wanted_pred_number_base: str) -> List[PredictivePseudo]:
-    target_ids = [
-        wanted_pred_number_base,
-        f"{wanted_pred_number_base}_RNA",
-        f"{wanted_pred_number_base}_DNA",
-
-        f"{wanted_pred_number_base}A",
-        f"{wanted_pred_number_base}B",
-        f"{wanted_pred_number_base}_A",
-        f"{wanted_pred_number_base}_B",
-        f"{wanted_pred_number_base}I",
-        f"{wanted_pred_number_base}II",
-        f"{wanted_pred_number_base}_I",
-        f"{wanted_pred_number_base}_II",
-        f"{wanted_pred_number_base}r",
-        f"{wanted_pred_number_base}_r",
-    ]
+    """All variants (_RNA, _DNA, A, II, ...) of a predictive number, found by their shared base"""
+    base = normalize(wanted_pred_number_base.strip()).base
     pseudonyms = (
         db.session
         .execute(
-            db.select(PredictivePseudo).filter(
-                PredictivePseudo.predictive_id_unified.in_(target_ids)
-            )
+            db.select(PredictivePseudo)
+            .filter(PredictivePseudo.predictive_base == base)
+            .order_by(PredictivePseudo.predictive_id_unified)
         )
         .scalars()
         .all()
@@ -156,43 +54,27 @@ def _look_if_pred_number_has_data(wanted_pred_number_base: str) -> List[Predicti
     return pseudonyms
 
 
+def find_files(files_we_look_for, path):
+    """Sample folders of all pseudonyms (None for unknown ones), from one index query or,
+    while the index is not built yet (manage.py build_run_index), from one traversal of the tree
+
+    Pseudonyms missing in the index are looked for only in the directories that changed since the
+    last index refresh (see find_unindexed_samples), most searches include variants without data.
+    """
+    if run_index_is_empty():
+        with FIND_FILE_SECONDS.labels("walk").time():
+            return run_search.find(path, files_we_look_for)
+
+    with FIND_FILE_SECONDS.labels("index").time():
+        paths = lookup_sample_paths(files_we_look_for)
+        missing = [pseudonym for pseudonym, sample_path in paths.items() if sample_path is None]
+        if missing:
+            paths.update(find_unindexed_samples(missing, app.config["RUN_INDEX_SETTLE_SECONDS"]))
+    return paths
+
+
 def find_file(file_we_look_for, path):
-    year_pattern = re.compile(r'^(19|20)\d{2}$')
-    year_dirs = [
-        name for name in os.listdir(path)
-        if os.path.isdir(os.path.join(path, name)) and year_pattern.match(name)
-    ]
-    for year_dir in year_dirs:
-        full_year_path = os.path.join(path, year_dir)
-
-        existing_sequence_types = [folder_sequence_type for folder_sequence_type in os.listdir(full_year_path)]
-
-        directories_with_runs = []
-
-        for sequence_type in existing_sequence_types:
-            match sequence_type:
-                case "MiSEQ":
-                    subdirs = ["complete-runs", "mamma-print", "missing-analysis"]
-                    for subdir in subdirs:
-                        miseq_path = os.path.join(full_year_path, "MiSEQ", subdir)
-                        if os.path.exists(miseq_path):
-                            directories_with_runs.append(miseq_path)
-                case "NextSeq":
-                    nextseq_path = os.path.join(full_year_path, "NextSeq")
-                    if os.path.exists(nextseq_path):
-                        directories_with_runs.append(nextseq_path)
-                case _:
-                    continue  # Skip any sequence_type that is not MiSEQ or NextSeq
-
-        for directory_with_runs in directories_with_runs:
-            for run in os.listdir(directory_with_runs):
-                sample_dir = os.path.join(directory_with_runs, run, "Samples")
-                if os.path.exists(sample_dir):
-                    for sample in os.listdir(sample_dir):
-                        if sample == file_we_look_for:
-                            return os.path.join(sample_dir, sample)
-
-    return None
+    return find_files([file_we_look_for], path)[file_we_look_for]
 
 
 @app.route("/")
@@ -212,88 +94,163 @@ def retrieveSequences():
         if not pseudonyms:
             return render_template("index-no-pred-number.html", pred_num=request.form["pred_number"])
 
+        # all variants are searched at once
+        paths = find_files([pseudo.predictive_pseudo_id for pseudo in pseudonyms], app.config["RUNS_FOLDER"])
         files = []
         for pseudo in pseudonyms:
-            path_to_file = find_file(pseudo.predictive_pseudo_id, "/RUNS")
             files.append({
                 "pseudonym": pseudo.predictive_pseudo_id,
                 "pred_number": pseudo.predictive_id_unified,
-                "path": path_to_file
+                "path": paths[pseudo.predictive_pseudo_id]
             })
 
-        session["files"] = files
-        session["base_pred_num"] = base_pred_num
+        search_id = search_results.save({"base_pred_num": base_pred_num, "files": files, "runs": _runs_of_files(files)})
+        # only the ID goes into the cookie, the result can be large
+        session["search_id"] = search_id
 
         return render_template("pathology_download.html",
                                base_pred_num=base_pred_num,
-                               files=files)
+                               files=files,
+                               search_id=search_id)
     else:
         return render_template("pathology_search.html")
 
 
-@app.route("/transfering_file_run", methods=["POST"])
-def transfer_file_run():
-    files = session.get("files", [])
-    runs_data: Dict[str, Dict[str, Any]] = {}
+def _runs_of_files(files):
+    """Run path and the pseudonyms and predictive numbers of all samples of every run holding a found sample"""
+    runs = {}
     for f in files:
-        parts = f["path"].strip("/").split("/")
-        if "Samples" in parts:
-            idx = parts.index("Samples")
-            run_path = "/" + "/".join(parts[:idx])  # Path up to the run
-            only_run = parts[idx - 1]
-            runs_data[only_run] = {"run_path": run_path}
-
-    missing_runs = {only_run: data for only_run, data in runs_data.items() if not os.path.exists(f"/RETRIEVED/{only_run}")}
-
-    if not missing_runs:
-        return jsonify({
-            "status": "already_exists",
-            "paths": [f"/NO-BACKUP-SPACE/RETRIEVED/{only_run}" for only_run in runs_data.keys()]
-        })
-
-    for only_run, data in missing_runs.items():
-        run_path = data["run_path"]
-        samples_pseudo = os.listdir(os.path.join(run_path, "Samples"))
-        samples_pred_raw = [
-            db.session.execute(db.Select(PredictivePseudo).filter_by(predictive_pseudo_id=pseudo)).one_or_none()
-            for pseudo in samples_pseudo
-        ]
-        samples_pred = [pred[0].predictive_id for pred in samples_pred_raw if pred is not None]
-
-        data["samples_pseudo"] = samples_pseudo
-        data["samples_pred"] = samples_pred
+        if f["path"] is None:
+            continue
+        # <run>/Samples/<sample>
+        run_path = os.path.dirname(os.path.dirname(f["path"]))
+        runs.setdefault(os.path.basename(run_path), {"run_path": run_path})
+
+    for data in runs.values():
+        resolved = resolve_ids("predictive", "from_pseudo", run_search.list_samples(data["run_path"]))
+        # samples without a known predictive number keep their pseudonym
+        data["samples_pseudo"] = [pseudo for pseudo, pred in resolved.items() if pred is not None]
+        data["samples_pred"] = [resolved[pseudo] for pseudo in data["samples_pseudo"]]
+    return runs
+
+
+def _requested_search():
+    """Stored result of the search a retrieval is requested for, sent as {"search_id": ...} in the
+    request body (the last search of the session by default), None when it expired"""
+    body = request.get_json(silent=True) or {}
+    return search_results.load(body.get("search_id") or session.get("search_id"))
+
+
+def _expired_search():
+    return jsonify(isError=True, message="The search results expired, search for the predictive number again",
+                   statusCode=404), 404
+
+
+def _requested_link_mode():
+    """Link mode of a retrieval, sent as {"link_mode": ...} in the request body, RETRIEVAL_LINK_MODE by default
+
+    Returns None for an unknown link mode.
+    """
+    body = request.get_json(silent=True) or {}
+    link_mode = body.get("link_mode") or app.config["RETRIEVAL_LINK_MODE"]
+    return link_mode if link_mode in LINK_MODES else None
+
+
+def _invalid_link_mode():
+    return jsonify(isError=True, message=f"Unknown link mode, expected one of {', '.join(LINK_MODES)}",
+                   statusCode=400), 400
+
+
+def _start_or_attach(destinations, start):
+    """Starts one job retrieving every destination that is neither retrieved nor being retrieved yet,
+    requests for destinations already being retrieved attach to the job retrieving them
+
+    Parameters
+    ----------
+    destinations : dict
+        Key (run or sample) -> final path in /RETRIEVED
+    start : callable
+        Called with the new job ID and the list of keys the job has to retrieve
+
+    Returns
+    -------
+    tuple
+        IDs of all jobs the request waits for, and whether a new job was started
+    """
+    job_ids = set()
+    pending = {}
+    for key, dest in destinations.items():
+        running = in_flight_job(dest)
+        if running is not None:
+            job_ids.add(running)
+        elif not os.path.exists(dest):
+            pending[key] = dest
+
+    started = False
+    if pending:
+        job_id = str(uuid.uuid4())
+        holders = claim_destinations(job_id, list(pending.values()), app.config["RETRIEVAL_CLAIM_TTL_SECONDS"])
+        claimed = [key for key, dest in pending.items() if holders[dest] == job_id]
+        job_ids.update(holder for holder in holders.values() if holder != job_id)
+        # a job may have published a destination between the exists check and the claim
+        published = [key for key in claimed if os.path.exists(pending[key])]
+        if published:
+            release_destinations(job_id, [pending[key] for key in published])
+            claimed = [key for key in claimed if key not in published]
+        if claimed:
+            start(job_id, claimed)
+            job_ids.add(job_id)
+            started = True
+    return sorted(job_ids), started
+
+
+def _retrieval_response(job_ids, started, paths):
+    if not job_ids:
+        return jsonify({"status": "already_exists", "paths": paths})
+    return jsonify({
+        "status": "started" if started else "attached",
+        "job_id": job_ids[0],
+        "job_ids": job_ids,
+        "paths": paths
+    })
 
-    job_id = str(uuid.uuid4())
 
-    copy_multiple_runs_task.delay(missing_runs, job_id)
+@app.route("/transfering_file_run", methods=["POST"])
+def transfer_file_run():
+    link_mode = _requested_link_mode()
+    if link_mode is None:
+        return _invalid_link_mode()
+    search = _requested_search()
+    if search is None:
+        return _expired_search()
+    runs_data: Dict[str, Dict[str, Any]] = search["runs"]
 
-    return jsonify({
-        "status": "started",
-        "job_id": job_id,
-        "paths": [f"/NO-BACKUP-SPACE/RETRIEVED/{only_run}" for only_run in missing_runs.keys()]
-    })
+    def start(job_id, runs):
+        copy_multiple_runs_task.delay({only_run: runs_data[only_run] for only_run in runs}, job_id, link_mode)
+
+    job_ids, started = _start_or_attach({only_run: f"/RETRIEVED/{only_run}" for only_run in runs_data}, start)
+    return _retrieval_response(job_ids, started,
+                               [f"/NO-BACKUP-SPACE/RETRIEVED/{only_run}" for only_run in runs_data.keys()])
 
 
 @app.route("/transfering_file_sample", methods=["POST"])
 def transfer_file_sample():
-    files = session.get("files", [])
-    missing_samples = [file for file in files if not os.path.exists(f"/RETRIEVED/{file['pred_number']}")]
+    link_mode = _requested_link_mode()
+    if link_mode is None:
+        return _invalid_link_mode()
+    search = _requested_search()
+    if search is None:
+        return _expired_search()
+    # samples missing in /RUNS cannot be retrieved
+    files = [f for f in search["files"] if f["path"] is not None]
 
-    if not missing_samples:
-        return jsonify({
-            "status": "already_exists",
-            "paths": [f"/NO-BACKUP-SPACE/RETRIEVED/{file['pseudonym']}" for file in files]
-        })
+    def start(job_id, indexes):
+        copy_multiple_samples_task.delay([files[i] for i in indexes], job_id, link_mode)
 
-    job_id = str(uuid.uuid4())
-
-    copy_multiple_samples_task.delay(missing_samples, job_id)
-
-    return jsonify({
-        "status": "started",
-        "job_id": job_id,
-        "paths": [f"/NO-BACKUP-SPACE/RETRIEVED/{f['pseudonym']}" for f in missing_samples]
-    })
+    job_ids, started = _start_or_attach({i: f"/RETRIEVED/{file['pred_number']}" for i, file in enumerate(files)},
+                                        start)
+    # the sample folders are renamed to their predictive numbers while copied
+    return _retrieval_response(job_ids, started, [f"/NO-BACKUP-SPACE/RETRIEVED/{f['pred_number']}" for f in files])
 
 
 #######################
@@ -323,26 +280,7 @@ def uploadFile():
 @app.route('/bbm-sequencing-download')
 def downloadData():
     data_file_path = session.get('upload_data_file_path', None)
-    if ".csv" in data_file_path:
-        print("IN CSV")
-        uploaded_df = pd.read_csv(data_file_path, sep=",")
-        print(uploaded_df.columns)
-        df = _add_sample_id_to_excel(uploaded_df, "csv")
-        df = _check_if_sample_has_sequencing(df)
-        download_file_name = "bbm_data_with_sequecing_info.csv"
-        df_path = os.path.join(app.config["DOWNLOAD_FOLDER"], download_file_name)
-        df.to_csv(df_path, sep=";", index=False)
-    elif ".xlsx" in data_file_path:
-        print("IN EXCEL")
-        uploaded_df = pd.read_excel(data_file_path, sheet_name="List1", engine="openpyxl")
-        print(uploaded_df.columns)
-        df = _add_sample_id_to_excel(uploaded_df, "xlsx")
-        df = _check_if_sample_has_sequencing(df)
-        download_file_name = "bbm_data_with_sequecing_info.xlsx"
-        df_path = os.path.join(app.config["DOWNLOAD_FOLDER"], download_file_name)
-        df.to_excel(df_path, sheet_name="List1", index=False)
-    else:
-        uploaded_df = None
+    if not is_supported_file(data_file_path):
         return '''
                 !DOCTYPE html>
                 <html>
@@ -355,98 +293,286 @@ def downloadData():
                 </html>
                 '''
 
-    return send_from_directory(app.config["DOWNLOAD_FOLDER"], download_file_name)
+    job_id = str(uuid.uuid4())
+
+    enrich_bbm_file_task.delay(data_file_path, job_id)
+
+    return render_template("bbm_sequencing_processing.html", job_id=job_id)
+
+
+@app.route('/bbm-sequencing-download/<job_id>')
+def downloadEnrichedData(job_id):
+    download_file_name = redis_client.get(f"bbm_download:{job_id}")
+    if download_file_name is None:
+        return jsonify(isError=True, message="File not ready or expired", statusCode=404), 404
+
+    return send_from_directory(os.path.join(app.config["DOWNLOAD_FOLDER"], job_id), download_file_name,
+                               as_attachment=True)
 
 ##########
 # DB API #
 ##########
 
 
-@app.route("/api/patient", methods=["POST"])
-def post_new_patient():
+# column -> JSON field of the records sent to the API
+API_FIELDS = {
+    PatientPseudo: {"patient_id": "patient_ID", "patient_pseudo_id": "patient_pseudo_ID"},
+    PredictivePseudo: {"predictive_id": "predictive_ID", "predictive_pseudo_id": "predictive_pseudo_ID"},
+    SamplePseudo: {"sample_id": "sample_ID", "sample_pseudo_id": "pseudo_sample_ID"},
+}
+# column identifying a record, records with a known value are duplicates
+KEY_COLUMNS = {PatientPseudo: "patient_id", PredictivePseudo: "predictive_id", SamplePseudo: "sample_id"}
+
+
+def _pseudo_row(record, fields):
+    try:
+        return {column: record[field] for column, field in fields.items()}
+    except (KeyError, TypeError):
+        return None
+
+
+def pseudo_rows(model, records, fields):
+    """Column values of a batch of JSON records of a pseudonymization table, None for records missing a field
+
+    Predictive numbers of the whole batch are normalized at once.
+    """
+    rows = [_pseudo_row(record, fields) for record in records]
+    if model is PredictivePseudo:
+        valid = [row for row in rows if row is not None]
+        for row, number in zip(valid, normalize_many([row["predictive_id"] for row in valid])):
+            row["predictive_id_unified"] = number.unified
+            row.update(number.index_columns)
+    return rows
+
+
+def _post_one(model):
     data = request.json
     print(data)
-    if data:
-        existing_data = PatientPseudo.query.filter_by(patient_id=data["patient_ID"]).first()
-        if existing_data is None:
-            db.session.add(PatientPseudo(patient_id=data["patient_ID"], patient_pseudo_id=data["patient_pseudo_ID"]))
-            db.session.commit()
-            return jsonify(isError=False, message="Success", statusCode=200, data=data), 200
-        else:
-            return jsonify(isError=True, message="Data already in database", statusCode=409, data=data), 409
-    else:
+    row = pseudo_rows(model, [data], API_FIELDS[model])[0] if data else None
+    if row is None:
         return jsonify(isError=True, message="Invalid input data", statusCode=404, data=data), 404
 
+    [status] = insert_new_rows(model, KEY_COLUMNS[model], [row])
+    db.session.commit()
+    pseudonym_cache.invalidate(model.__tablename__, [row])
+    if status == CREATED:
+        return jsonify(isError=False, message="Success", statusCode=200, data=data), 200
+    else:
+        return jsonify(isError=True, message="Data already in database", statusCode=409, data=data), 409
+
+
+@app.route("/api/patient", methods=["POST"])
+def post_new_patient():
+    return _post_one(PatientPseudo)
+
 
 @app.route("/api/predictive", methods=["POST"])
 def post_new_predictive():
-    data = request.json
-    print(data)
-    if data:
-        existing_data = PredictivePseudo.query.filter_by(predictive_id=data["predictive_ID"]).first()
-        if existing_data is None:
-            db.session.add(PredictivePseudo(predictive_id=data["predictive_ID"], predictive_id_unified=modify_predictive_number(data["predictive_ID"]), predictive_pseudo_id=data["predictive_pseudo_ID"]))
-            db.session.commit()
-            return jsonify(isError=False, message="Success", statusCode=200, data=data), 200
-        else:
-            return jsonify(isError=True, message="Data already in database", statusCode=409, data=data), 409
-    else:
-        return jsonify(isError=True, message="Invalid input data", statusCode=404, data=data), 404
+    return _post_one(PredictivePseudo)
 
 
 @app.route("/api/sample", methods=["POST"])
 def post_new_sample():
+    return _post_one(SamplePseudo)
+
+
+def _post_batch(model):
     data = request.json
-    print(data)
-    if data:
-        existing_data = SamplePseudo.query.filter_by(sample_id=data["sample_ID"]).first()
-        if existing_data is None:
-            db.session.add(SamplePseudo(sample_id=data["sample_ID"], sample_pseudo_id=data["pseudo_sample_ID"]))
-            db.session.commit()
-            return jsonify(isError=False, message="Success", statusCode=200, data=data), 200
-        else:
-            return jsonify(isError=True, message="Data already in database", statusCode=409, data=data), 409
-    else:
+    if not isinstance(data, list) or not data:
         return jsonify(isError=True, message="Invalid input data", statusCode=404, data=None), 404
 
+    key = KEY_COLUMNS[model]
+    key_field = API_FIELDS[model][key]
+    statuses = []
+    rows = []
+    for batch in batched(data, app.config["BULK_INSERT_BATCH_SIZE"]):
+        batch_rows = pseudo_rows(model, batch, API_FIELDS[model])
+        statuses.extend(insert_new_rows(model, key, batch_rows))
+        rows.extend(row for row, status in zip(batch_rows, statuses[-len(batch_rows):]) if status == CREATED)
+    db.session.commit()
+    pseudonym_cache.invalidate(model.__tablename__, rows)
+
+    results = [
+        {"index": i, key_field: record.get(key_field) if isinstance(record, dict) else None, "status": status}
+        for i, (record, status) in enumerate(zip(data, statuses))
+    ]
+    return jsonify(isError=False, message="Success", statusCode=200, data=results,
+                   created=statuses.count(CREATED), duplicates=statuses.count(DUPLICATE),
+                   invalid=statuses.count(INVALID)), 200
+
+
+@app.route("/api/patient/batch", methods=["POST"])
+def post_new_patients():
+    return _post_batch(PatientPseudo)
+
+
+@app.route("/api/predictive/batch", methods=["POST"])
+def post_new_predictives():
+    return _post_batch(PredictivePseudo)
+
+
+@app.route("/api/sample/batch", methods=["POST"])
+def post_new_samples():
+    return _post_batch(SamplePseudo)
+
+
+def _load_records(model, column, values):
+    key_column = getattr(model, column)
+    records = {}
+    for chunk in batched(values, app.config["SAMPLE_LOOKUP_CHUNK_SIZE"]):
+        for record in db.session.execute(db.select(model).where(key_column.in_(chunk)).order_by(model.id)).scalars():
+            records.setdefault(getattr(record, column), record.serialize)
+    return records
+
+
+def lookup_records(model, column, values):
+    """Serialized records by value of column (None for unknown values), served from pseudonym_cache"""
+    return pseudonym_cache.get_many(model.__tablename__, column, values,
+                                    lambda missing: _load_records(model, column, missing))
+
+
+# entity -> model, ID column and pseudonym column
+RESOLVE_ENTITIES = {
+    "patient": (PatientPseudo, "patient_id", "patient_pseudo_id"),
+    "predictive": (PredictivePseudo, "predictive_id", "predictive_pseudo_id"),
+    "sample": (SamplePseudo, "sample_id", "sample_pseudo_id"),
+}
+RESOLVE_DIRECTIONS = ("to_pseudo", "from_pseudo")
+# column -> field of the serialized record
+_SERIALIZED_FIELDS = {
+    "patient_id": "patient_ID", "patient_pseudo_id": "patient_pseudo_ID",
+    "predictive_id": "predictive_ID", "predictive_pseudo_id": "predictive_pseudo_ID",
+    "sample_id": "sample_ID", "sample_pseudo_id": "sample_pseudo_ID",
+}
+
+
+def resolve_ids(entity, direction, values):
+    """Resolves IDs to pseudonyms (to_pseudo) or pseudonyms to IDs (from_pseudo) with one set-based lookup
+
+    Returns
+    -------
+    dict
+        Value -> resolved value, None for unknown values
+    """
+    model, id_column, pseudo_column = RESOLVE_ENTITIES[entity]
+    from_column, to_column = (id_column, pseudo_column) if direction == "to_pseudo" else (pseudo_column, id_column)
+    records = lookup_records(model, from_column, values)
+    return {value: record[_SERIALIZED_FIELDS[to_column]] if record else None for value, record in records.items()}
+
+
+@app.route("/api/resolve", methods=["POST"])
+def resolve():
+    """Resolves {"entity": ..., "direction": "to_pseudo"/"from_pseudo", "ids": [...]} into JSON lines
+    {"id": ..., "resolved": ...}, streamed chunk by chunk"""
+    data = request.get_json(silent=True)
+    if (not isinstance(data, dict) or data.get("entity") not in RESOLVE_ENTITIES
+            or data.get("direction", "to_pseudo") not in RESOLVE_DIRECTIONS or not isinstance(data.get("ids"), list)):
+        return jsonify(isError=True, message="Invalid input data", statusCode=404, data=data), 404
+
+    entity, direction = data["entity"], data.get("direction", "to_pseudo")
+    ids = [str(value) for value in data["ids"]]
+
+    def generate():
+        for chunk in batched(ids, app.config["SAMPLE_LOOKUP_CHUNK_SIZE"]):
+            resolved = resolve_ids(entity, direction, chunk)
+            yield "".join(json.dumps({"id": value, "resolved": resolved[value]}) + "\n" for value in chunk)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 
 @app.route("/api/patient/<wanted_patient_id>", methods=["GET"])
 def get_patient_by_patient_id(wanted_patient_id):
-    patient = PatientPseudo.query.filter_by(patient_id=wanted_patient_id).first()
+    patient = lookup_records(PatientPseudo, "patient_id", [wanted_patient_id])[wanted_patient_id]
     if patient:
-        return jsonify(patient.serialize)
+        return jsonify(patient)
     else:
         return jsonify(isError=True, message="Patient not found", statusCode=404), 404
 
 
+@app.route("/api/predictive", methods=["GET"])
+def list_predictives():
+    """Lists predictive numbers whose base starts with ?prefix= and/or whose year is within ?year_from=&year_to="""
+    year_from = request.args.get("year_from", type=int)
+    year_to = request.args.get("year_to", type=int)
+    limit = min(request.args.get("limit", 100, type=int), 1000)
+    offset = request.args.get("offset", 0, type=int)
+    prefix = request.args.get("prefix")
+    if limit < 0 or offset < 0:
+        return jsonify(isError=True, message="Invalid input data", statusCode=404, data=None), 404
+
+    query = db.select(PredictivePseudo)
+    if prefix:
+        prefix = modify_predictive_number(prefix.strip())
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(PredictivePseudo.predictive_base.like(f"{escaped}%", escape="\\"))
+    if year_from is not None:
+        query = query.filter(PredictivePseudo.predictive_year >= year_from)
+    if year_to is not None:
+        query = query.filter(PredictivePseudo.predictive_year <= year_to)
+    query = query.order_by(PredictivePseudo.predictive_base, PredictivePseudo.predictive_id_unified)
+
+    predictives = db.session.execute(query.limit(limit).offset(offset)).scalars()
+    return jsonify([predictive.serialize for predictive in predictives])
+
+
 @app.route("/api/predictive/<wanted_predictive_id>", methods=["GET"])
 def get_predictive_by_predictive_id(wanted_predictive_id):
-    predictive = PredictivePseudo.query.filter_by(predictive_id=wanted_predictive_id).first()
+    predictive = lookup_records(PredictivePseudo, "predictive_id", [wanted_predictive_id])[wanted_predictive_id]
     if predictive:
-        return jsonify(predictive.serialize)
+        return jsonify(predictive)
     else:
         return jsonify(isError=True, message="Predictive number not found", statusCode=404), 404
 
 
 @app.route("/api/sample/<wanted_sample_id>", methods=["GET"])
 def get_sample_by_sample_id(wanted_sample_id):
-    sample = SamplePseudo.query.filter_by(sample_id=wanted_sample_id).first()
+    sample = lookup_records(SamplePseudo, "sample_id", [wanted_sample_id])[wanted_sample_id]
     if sample:
-        return jsonify(sample.serialize)
+        return jsonify(sample)
     else:
         return jsonify(isError=True, message="Sample not found", statusCode=404), 404
 
 
+@app.route("/api/cache-stats", methods=["GET"])
+def get_cache_stats():
+    return jsonify(pseudonym_cache.stats())
+
+
 @app.route('/job-status/<job_id>')
 def job_status(job_id):
+    heartbeat_seconds = app.config["JOB_STATUS_HEARTBEAT_SECONDS"]
 
     def event_stream():
-        pubsub = redis_client.pubsub()
-        pubsub.subscribe(job_id)
-        for message in pubsub.listen():
-            if message['type'] == 'message':
-                yield f"data: {message['data']}\n\n"
-    return Response(event_stream(), mimetype='text/event-stream')
+        events = job_event_hub.subscribe(job_id)
+        try:
+            # a late joiner starts from the latest state, events published before the hub's subscription
+            # is in place are replayed by the hub as latest states, so none is lost
+            latest = redis_client.get(job_state_key(job_id))
+            if latest is not None:
+                yield f"data: {latest}\n\n"
+                if json.loads(latest).get("status") in TERMINAL_STATUSES:
+                    return
+            while True:
+                try:
+                    data = events.get(timeout=heartbeat_seconds)
+                except queue.Empty:
+                    # SSE comment, ignored by EventSource, lets the worker notice closed connections
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"data: {data}\n\n"
+                if json.loads(data).get("status") in TERMINAL_STATUSES:
+                    return
+        finally:
+            # also runs when the client disconnects and the worker closes the generator
+            job_event_hub.unsubscribe(job_id, events)
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(latest_metrics(), content_type=CONTENT_TYPE_LATEST)
 
 
 @app.route("/health", methods=["GET"])
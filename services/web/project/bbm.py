@@ -0,0 +1,169 @@
+import os
+from typing import Dict, List
+
+import openpyxl
+import pandas as pd
+
+from .app import db
+from .models import SamplePseudo
+
+BBM_parts = {
+    "": ["1", "2", "3", "4", "5", "53", "54", "55", "56"],
+    "s": ["K", "L", "PD", "S", "SD", "T"],
+    "b": ["7", "PR"],
+    "d": ["gD", "PK"]
+}
+MATERIAL_BBM_PART = {material: part for part, materials in BBM_parts.items() for material in materials}
+
+
+def _add_sample_id_to_excel(df, type_of_df):
+    columns = [column for column in df.columns if "prohláš" in str(column) and "číslo" in str(column)]
+    if not columns:
+        raise ValueError('The file has no "prohlášení číslo" column')
+    row_val = columns[0]
+
+    materials = df["materiál"].astype(str).str.split("/", n=1).str[0]
+    biobank_parts = materials.map(MATERIAL_BBM_PART)
+    numbers = df[row_val].map(str).astype(str).str.replace("/", ":", regex=False)
+
+    # rows with material outside of BBM_parts cannot get sample_id, they are flagged instead
+    df["sample_id"] = ("BBM" + biobank_parts + ":20" + numbers + ":" + materials).where(biobank_parts.notna())
+    df["unknown material"] = biobank_parts.isna()
+
+    return df
+
+
+def _lookup_sample_pseudonyms(sample_ids: List[str], chunk_size: int = 1000) -> Dict[str, str]:
+    unique_ids = list(dict.fromkeys(sample_id for sample_id in sample_ids if sample_id))
+    pseudonyms = {}
+    for start in range(0, len(unique_ids), chunk_size):
+        rows = db.session.execute(
+            db.select(SamplePseudo.sample_id, SamplePseudo.sample_pseudo_id)
+            .filter(SamplePseudo.sample_id.in_(unique_ids[start:start + chunk_size]))
+            .order_by(SamplePseudo.id)
+        )
+        for sample_id, sample_pseudo_id in rows:
+            pseudonyms.setdefault(sample_id, sample_pseudo_id)
+    return pseudonyms
+
+
+def _check_if_sample_has_sequencing(df, lookup_chunk_size):
+    pseudonyms = _lookup_sample_pseudonyms(df["sample_id"].dropna().tolist(), lookup_chunk_size)
+    df["sample_pseudo_id"] = df["sample_id"].map(pseudonyms)
+    df["has sequencing"] = df["sample_pseudo_id"].notna()
+    return df
+
+
+def _read_csv_chunks(data_file_path, chunk_rows):
+    yield from pd.read_csv(data_file_path, sep=",", dtype=str, chunksize=chunk_rows)
+
+
+def _read_xlsx_chunks(data_file_path, chunk_rows):
+    workbook = openpyxl.load_workbook(data_file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook["List1"].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [f"Unnamed: {i}" if name is None else name for i, name in enumerate(header)]
+
+        batch = []
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            batch.append(row)
+            if len(batch) == chunk_rows:
+                yield pd.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns)
+    finally:
+        workbook.close()
+
+
+class _CsvWriter:
+    def __init__(self, path):
+        self.path = path
+        self.header = True
+
+    def write(self, df):
+        df.to_csv(self.path, sep=";", index=False, header=self.header, mode="w" if self.header else "a")
+        self.header = False
+
+    def close(self):
+        if self.header:
+            open(self.path, "w").close()
+
+
+class _XlsxWriter:
+    def __init__(self, path):
+        self.path = path
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet("List1")
+        self.header = True
+
+    def write(self, df):
+        if self.header:
+            self.sheet.append(list(df.columns))
+            self.header = False
+        df = df.astype(object).where(df.notna(), None)
+        for row in df.itertuples(index=False, name=None):
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+def is_supported_file(data_file_path):
+    return data_file_path is not None and (".csv" in data_file_path or ".xlsx" in data_file_path)
+
+
+def enrich_file(data_file_path, download_folder, chunk_rows=5000, lookup_chunk_size=1000, progress=None):
+    """Adds sample_id and sequencing information to an uploaded BBM export
+
+    The file is processed chunk_rows rows at a time (CSV through pandas chunks, XLSX through
+    openpyxl read-only mode) and every enriched chunk is appended to the output file, so memory
+    use does not grow with the size of the upload.
+
+    Parameters
+    ----------
+    data_file_path : str
+        Path of the uploaded CSV or XLSX file
+    download_folder : str
+        Folder where the enriched file is written
+    chunk_rows : int
+        Number of rows processed at once
+    lookup_chunk_size : int
+        Number of sample IDs sent to the database in one query
+    progress : callable, optional
+        Called with the number of rows processed so far after every chunk
+
+    Returns
+    -------
+    str or None
+        Name of the enriched file inside download_folder, None for unsupported file types
+    """
+    if ".csv" in data_file_path:
+        download_file_name = "bbm_data_with_sequecing_info.csv"
+        chunks = _read_csv_chunks(data_file_path, chunk_rows)
+        writer = _CsvWriter(os.path.join(download_folder, download_file_name))
+        type_of_df = "csv"
+    elif ".xlsx" in data_file_path:
+        download_file_name = "bbm_data_with_sequecing_info.xlsx"
+        chunks = _read_xlsx_chunks(data_file_path, chunk_rows)
+        writer = _XlsxWriter(os.path.join(download_folder, download_file_name))
+        type_of_df = "xlsx"
+    else:
+        return None
+
+    rows_done = 0
+    for chunk in chunks:
+        df = _add_sample_id_to_excel(chunk, type_of_df)
+        df = _check_if_sample_has_sequencing(df, lookup_chunk_size)
+        writer.write(df)
+        rows_done += len(df)
+        if progress is not None:
+            progress(rows_done)
+    writer.close()
+
+    return download_file_name
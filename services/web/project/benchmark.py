@@ -0,0 +1,268 @@
+import csv
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+
+import openpyxl
+from sqlalchemy import inspect
+
+from . import find_file, find_files, run_search, _look_if_pred_number_has_data
+from .app import db
+from .bbm import enrich_file
+from .models import PatientPseudo, PredictivePseudo, SamplePseudo
+from .predictive_number import normalize, normalize_many
+from .run_index import IndexedDirectory, RunSample, build_run_index
+from .utils import plan_copy, threaded_copy
+
+# runs per year and sequencer, samples per run, rows of the BBM export, bytes of every FASTQ file
+SIZES = {
+    "small": {"runs": 5, "samples": 8, "rows": 1000, "fastq_bytes": 64 * 1024},
+    "medium": {"runs": 25, "samples": 16, "rows": 10000, "fastq_bytes": 1024 * 1024},
+    "large": {"runs": 100, "samples": 24, "rows": 50000, "fastq_bytes": 4 * 1024 * 1024},
+}
+YEARS = ("2021", "2022", "2023")
+SUFFIXES = ("", "_RNA", "_DNA")
+BBM_MATERIALS = ("1", "K", "PR", "gD", "ZZ")
+_PREDICTIVE_LOOKUPS = 100
+# most variants a predictive number has
+_VARIANTS = 13
+
+
+def database_is_empty():
+    """Whether no pseudonymization record or indexed run exists, the benchmark only seeds empty databases
+
+    Missing tables count as empty, so the check can run before migrate_schema touches the database.
+    """
+    existing_tables = set(inspect(db.engine).get_table_names())
+    return all(db.session.execute(db.select(model.id).limit(1)).first() is None
+               for model in (PatientPseudo, PredictivePseudo, SamplePseudo, RunSample)
+               if model.__tablename__ in existing_tables)
+
+
+def make_runs_tree(root, runs, samples, fastq_bytes, full_runs=1):
+    """Creates an OrganisedRuns tree with runs MiSEQ and NextSeq runs per year of samples samples each
+
+    Sample folders are named by predictive pseudonyms, every sample gets a FASTQ file of fastq_bytes
+    and a _StatInfo file, every run a SampleSheet.csv and Alignment/AdapterCounts.txt listing its samples.
+    Only the FASTQ files of the first full_runs runs (the retrieval benchmark copies the first one)
+    hold data, the others are sparse files of the same size and take no disk space.
+
+    Returns
+    -------
+    list of tuple
+        (predictive number, predictive pseudonym, run path) of every sample
+    """
+    created = []
+    payload = os.urandom(min(fastq_bytes, 1024 * 1024))
+    number = 0
+    runs_created = 0
+    for year in YEARS:
+        for sequencer_type, container in (("MiSEQ", os.path.join("MiSEQ", "complete-runs")), ("NextSeq", "NextSeq")):
+            for run in range(runs):
+                run_path = os.path.join(root, year, container, f"{year[2:]}0101_{sequencer_type}_{run:04d}")
+                pseudonyms = [f"mmci_predictive_{uuid.uuid4()}" for _ in range(samples)]
+                os.makedirs(os.path.join(run_path, "Alignment"))
+                with open(os.path.join(run_path, "SampleSheet.csv"), "w") as f:
+                    f.write("Sample_ID\n" + "\n".join(pseudonyms) + "\n")
+                with open(os.path.join(run_path, "Alignment", "AdapterCounts.txt"), "w") as f:
+                    f.write("\t".join(pseudonyms) + "\n")
+
+                for pseudonym in pseudonyms:
+                    sample_path = os.path.join(run_path, "Samples", pseudonym)
+                    os.makedirs(os.path.join(sample_path, "FASTQ"))
+                    os.makedirs(os.path.join(sample_path, "Analysis"))
+                    with open(os.path.join(sample_path, "FASTQ", f"{pseudonym}_S1_L001_R1_001.fastq.gz"), "wb") as f:
+                        if runs_created < full_runs:
+                            for _ in range(fastq_bytes // len(payload)):
+                                f.write(payload)
+                            f.write(payload[:fastq_bytes % len(payload)])
+                        else:
+                            f.truncate(fastq_bytes)
+                    with open(os.path.join(sample_path, "Analysis", f"{pseudonym}_StatInfo.txt"), "w") as f:
+                        f.write(f"Sample\t{pseudonym}\n")
+                    number += 1
+                    pred_number = f"{year[2:]}-{number}{SUFFIXES[number % len(SUFFIXES)]}"
+                    created.append((pred_number, pseudonym, run_path))
+                runs_created += 1
+    return created
+
+
+def make_bbm_export(file_name, rows):
+    """Writes a BBM export (CSV or XLSX by the extension) of rows samples, a third of them is sequenced
+
+    Returns
+    -------
+    list of str
+        sample_id of the sequenced samples, to be inserted into the database
+    """
+    header = ["materiál", "prohlášení číslo", "poznámka"]
+    records = [[BBM_MATERIALS[i % len(BBM_MATERIALS)], f"23/{i}", f"row {i}"] for i in range(rows)]
+    if file_name.endswith(".xlsx"):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("List1")
+        sheet.append(header)
+        for record in records:
+            sheet.append(record)
+        workbook.save(file_name)
+    else:
+        with open(file_name, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(records)
+
+    parts = {"1": "", "K": "s", "PR": "b", "gD": "d"}
+    return [f"BBM{parts[material]}:2023:{i}:{material}" for i, (material, _, _) in enumerate(records)
+            if material in parts and i % 3 == 0]
+
+
+def _seed_database(samples, sequenced_sample_ids):
+    db.session.execute(db.insert(PredictivePseudo), [
+        {"predictive_id": pred_number, "predictive_pseudo_id": pseudonym,
+         "predictive_id_unified": number.unified, **number.index_columns}
+        for (pred_number, pseudonym, _), number in zip(samples, normalize_many([s[0] for s in samples]))
+    ])
+    db.session.execute(db.insert(SamplePseudo), [
+        {"sample_id": sample_id, "sample_pseudo_id": f"mmci_sample_{uuid.uuid4()}"} for sample_id in sequenced_sample_ids
+    ])
+    db.session.commit()
+
+
+def _clear_database():
+    for model in (RunSample, IndexedDirectory, PredictivePseudo, SamplePseudo):
+        db.session.execute(db.delete(model))
+    db.session.commit()
+
+
+def _measure(results, name, size, items, repeat, run, setup=None):
+    """Times run repeat times (setup, if any, before every run and outside of the timing)"""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    results.append({
+        "benchmark": name,
+        "size": size,
+        "items": items,
+        "best_seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+    })
+
+
+def _bench_find_file(results, size, repeat, root, samples):
+    # an unknown pseudonym is the worst case, the walk visits every run
+    wanted = f"mmci_predictive_{uuid.uuid4()}"
+    variants = [pseudonym for _, pseudonym, _ in samples[::max(1, len(samples) // _VARIANTS)]][:_VARIANTS]
+    # cold listing cache, as for the first search after RUN_LISTING_CACHE_SECONDS
+    _measure(results, "find_file walk", size, len(samples), repeat, lambda: find_file(wanted, root),
+             setup=run_search.cache.clear)
+    _measure(results, "find_files walk variants", size, len(samples), repeat, lambda: find_files(variants, root),
+             setup=run_search.cache.clear)
+    build_run_index(root)
+    db.session.commit()
+    # the listing cache is cleared as for the walks, nothing may be served from the walks before
+    _measure(results, "find_file index", size, len(samples), repeat, lambda: find_file(wanted, root),
+             setup=run_search.cache.clear)
+    _measure(results, "find_files index variants", size, len(samples), repeat, lambda: find_files(variants, root))
+
+
+def _bench_predictive_lookup(results, size, repeat, samples):
+    step = max(1, len(samples) // _PREDICTIVE_LOOKUPS)
+    wanted = [pred_number for pred_number, _, _ in samples[::step]]
+
+    def lookup():
+        for pred_number in wanted:
+            _look_if_pred_number_has_data(pred_number)
+
+    _measure(results, "predictive lookup", size, len(wanted), repeat, lookup)
+
+    numbers = [pred_number for pred_number, _, _ in samples]
+    _measure(results, "normalize", size, len(numbers), repeat, lambda: [normalize(n) for n in numbers])
+    _measure(results, "normalize_many", size, len(numbers), repeat, lambda: normalize_many(numbers))
+
+
+def _bench_enrichment(results, size, repeat, tmp, rows):
+    download_folder = os.path.join(tmp, "downloads")
+    os.makedirs(download_folder)
+    for extension in ("csv", "xlsx"):
+        file_name = os.path.join(tmp, f"bbm_export.{extension}")
+        _measure(results, f"enrich {extension}", size, rows, repeat, lambda: enrich_file(file_name, download_folder))
+
+
+def _bench_retrieval(results, size, repeat, tmp, samples):
+    run_path = samples[0][2]
+    run_samples = [(pred_number, pseudonym) for pred_number, pseudonym, path in samples if path == run_path]
+    pred_numbers = [pred_number for pred_number, _ in run_samples]
+    pseudonyms = [pseudonym for _, pseudonym in run_samples]
+    retrieved = os.path.join(tmp, "RETRIEVED")
+    dest = os.path.join(retrieved, os.path.basename(run_path))
+
+    def clean():
+        shutil.rmtree(retrieved, ignore_errors=True)
+        os.makedirs(retrieved)
+
+    # planning walks the run and renames every pseudonymized folder and file
+    _measure(results, "plan_copy run", size, len(run_samples), repeat,
+             lambda: plan_copy(run_path, dest, pseudonyms, pred_numbers, True), setup=clean)
+    for link_mode in ("copy", "hardlink"):
+        _measure(results, f"threaded_copy run {link_mode}", size, len(run_samples), repeat,
+                 lambda: threaded_copy(run_path, dest, pseudonyms, pred_numbers, True, None,
+                                       zero_copy_min_bytes=0, link_mode=link_mode),
+                 setup=clean)
+
+
+BENCHMARKS = ("find_file", "predictive", "enrichment", "retrieval")
+
+
+def run_benchmarks(sizes=("small",), repeat=3, only=BENCHMARKS, keep=False):
+    """Times the search, enrichment and retrieval paths on synthetic data of every size in sizes
+
+    Every size gets its own OrganisedRuns tree and BBM exports in a temporary folder and its
+    own rows in the (empty) database, both are removed again afterwards.
+
+    Parameters
+    ----------
+    sizes : iterable of str
+        Keys of SIZES
+    repeat : int
+        Runs of every benchmark, the best and the median run are reported
+    only : iterable of str
+        Benchmarks to run, see BENCHMARKS
+    keep : bool
+        Whether to keep the generated files (their folder is printed)
+
+    Returns
+    -------
+    list of dict
+        benchmark, size, items, best_seconds and median_seconds of every measurement
+    """
+    results = []
+    for size in sizes:
+        params = SIZES[size]
+        tmp = tempfile.mkdtemp(prefix=f"seq-benchmark-{size}-")
+        try:
+            samples = make_runs_tree(os.path.join(tmp, "RUNS"), params["runs"], params["samples"], params["fastq_bytes"])
+            bbm_sample_ids = make_bbm_export(os.path.join(tmp, "bbm_export.csv"), params["rows"])
+            make_bbm_export(os.path.join(tmp, "bbm_export.xlsx"), params["rows"])
+            _seed_database(samples, bbm_sample_ids)
+
+            if "find_file" in only:
+                _bench_find_file(results, size, repeat, os.path.join(tmp, "RUNS"), samples)
+            if "predictive" in only:
+                _bench_predictive_lookup(results, size, repeat, samples)
+            if "enrichment" in only:
+                _bench_enrichment(results, size, repeat, tmp, params["rows"])
+            if "retrieval" in only:
+                _bench_retrieval(results, size, repeat, tmp, samples)
+        finally:
+            _clear_database()
+            if keep:
+                print(f"Generated data of {size} kept in {tmp}")
+            else:
+                shutil.rmtree(tmp)
+    return results
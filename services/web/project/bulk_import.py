@@ -0,0 +1,105 @@
+import itertools
+import json
+import re
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .app import db
+
+_CHUNK_SIZE = 1024 * 1024
+_SEPARATORS = " \t\r\n,"
+
+CREATED = "created"
+DUPLICATE = "duplicate"
+INVALID = "invalid"
+
+_DIALECT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def iter_json_records(file_name, list_name, chunk_size=_CHUNK_SIZE):
+    """Yields the records of the list_name array of a {list_name: [...]} JSON file one by one,
+    without loading the whole file into memory"""
+    decoder = json.JSONDecoder()
+    start = re.compile(re.escape(json.dumps(list_name)) + r"\s*:\s*\[")
+    with open(file_name) as f:
+        buf = ""
+        while (match := start.search(buf)) is None:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"{file_name} has no {list_name} list")
+            buf += chunk
+        pos = match.end()
+
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in _SEPARATORS:
+                pos += 1
+            if buf.startswith("]", pos):
+                return
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                # parsed records are dropped once per chunk, slicing them off per record copies the buffer every time
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield record
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _insert_ignoring_duplicates(model, key):
+    """INSERT ... ON CONFLICT (key) DO NOTHING RETURNING key, in the dialect of the database"""
+    insert = _DIALECT_INSERTS[db.engine.dialect.name]
+    # Core insert on the table, the ORM one would add the primary key to RETURNING
+    key_column = model.__table__.c[key]
+    return insert(model.__table__).on_conflict_do_nothing(index_elements=[key_column]).returning(key_column)
+
+
+def insert_new_rows(model, key, rows):
+    """Inserts the rows whose key is not in the table yet with one multi-row INSERT ... ON CONFLICT DO NOTHING
+
+    The unique index on key makes the duplicate check atomic, concurrent inserts of one key
+    create it exactly once.
+
+    Parameters
+    ----------
+    model : db.Model
+        Pseudonymization table
+    key : str
+        Unique column identifying a record (e.g. patient_id)
+    rows : list of dict
+        Column values of every record, None for records that could not be parsed
+
+    Returns
+    -------
+    list of str
+        CREATED, DUPLICATE (already in the table or earlier in rows) or INVALID for every row
+    """
+    first_rows = {}
+    for i, row in enumerate(rows):
+        if row is not None:
+            first_rows.setdefault(row[key], (i, row))
+
+    inserted = set()
+    if first_rows:
+        inserted.update(db.session.execute(_insert_ignoring_duplicates(model, key),
+                                           [row for _, row in first_rows.values()]).scalars())
+
+    statuses = []
+    for i, row in enumerate(rows):
+        if row is None:
+            statuses.append(INVALID)
+        elif row[key] in inserted and first_rows[row[key]][0] == i:
+            statuses.append(CREATED)
+        else:
+            statuses.append(DUPLICATE)
+    return statuses
@@ -9,6 +9,25 @@ def make_celery(app):
         backend="redis://redis:6379/0"
     )
     celery.conf.update(app.config)
+    # late acknowledged tasks (copies) are delivered again after this when their worker vanished,
+    # it has to exceed the longest copy, or a running copy would be started a second time
+    celery.conf.broker_transport_options = {"visibility_timeout": app.config["CELERY_VISIBILITY_TIMEOUT_SECONDS"]}
+    # a worker busy with a long copy does not hold back further tasks
+    celery.conf.worker_prefetch_multiplier = 1
+    celery.conf.beat_schedule = {
+        "refresh-run-index": {
+            "task": "project.tasks.refresh_run_index_task",
+            "schedule": app.config["RUN_INDEX_REFRESH_SECONDS"],
+        },
+        "remove-stale-stagings": {
+            "task": "project.tasks.remove_stale_stagings_task",
+            "schedule": app.config["RETRIEVAL_STAGING_CLEANUP_SECONDS"],
+        },
+        "remove-expired-bbm-files": {
+            "task": "project.tasks.remove_expired_bbm_files_task",
+            "schedule": app.config["BBM_CLEANUP_SECONDS"],
+        },
+    }
 
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):
@@ -8,5 +8,44 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config(object):
     DOWNLOAD_FOLDER = "/home/app/web/downloads/"
     UPLOAD_FOLDER = "/home/app/web/uploads"
+    RUNS_FOLDER = os.getenv("RUNS_FOLDER", "/RUNS")
+    COPY_WORKERS = int(os.getenv("COPY_WORKERS", 8))
+    COPY_ZERO_COPY_MIN_BYTES = int(os.getenv("COPY_ZERO_COPY_MIN_BYTES", 16 * 1024 * 1024))
+    # "copy", "reflink" or "hardlink", only used when /RUNS and /RETRIEVED are on the same filesystem
+    RETRIEVAL_LINK_MODE = os.getenv("RETRIEVAL_LINK_MODE", "copy")
+    RETRIEVAL_MAX_PARALLEL_COPIES = int(os.getenv("RETRIEVAL_MAX_PARALLEL_COPIES", 2))
+    RETRIEVAL_SLOT_POLL_SECONDS = float(os.getenv("RETRIEVAL_SLOT_POLL_SECONDS", 2.0))
+    # claims of requested retrievals whose task has not started yet expire after this
+    RETRIEVAL_CLAIM_TTL_SECONDS = int(os.getenv("RETRIEVAL_CLAIM_TTL_SECONDS", 3600))
+    # running retrievals renew their claims and copy slot while copying, those of a killed worker expire after this
+    RETRIEVAL_LEASE_SECONDS = int(os.getenv("RETRIEVAL_LEASE_SECONDS", 120))
+    # staging directories of retrievals that copied nothing for this long are removed
+    RETRIEVAL_STAGING_MAX_AGE_SECONDS = int(os.getenv("RETRIEVAL_STAGING_MAX_AGE_SECONDS", 2 * 86400))
+    RETRIEVAL_STAGING_CLEANUP_SECONDS = int(os.getenv("RETRIEVAL_STAGING_CLEANUP_SECONDS", 3600))
+    CELERY_VISIBILITY_TIMEOUT_SECONDS = int(os.getenv("CELERY_VISIBILITY_TIMEOUT_SECONDS", 24 * 3600))
+    JOB_PROGRESS_INTERVAL_SECONDS = float(os.getenv("JOB_PROGRESS_INTERVAL_SECONDS", 1.0))
+    JOB_STATUS_HEARTBEAT_SECONDS = float(os.getenv("JOB_STATUS_HEARTBEAT_SECONDS", 15.0))
+    RUN_INDEX_REFRESH_SECONDS = int(os.getenv("RUN_INDEX_REFRESH_SECONDS", 600))
+    RUN_INDEX_SETTLE_SECONDS = int(os.getenv("RUN_INDEX_SETTLE_SECONDS", 86400))
+    # older runs are checked for added samples once in this period, a share of them on every refresh
+    RUN_INDEX_SWEEP_SECONDS = int(os.getenv("RUN_INDEX_SWEEP_SECONDS", 86400))
+    # searching /RUNS without the run index: parallel directory listings and lifetime of cached listings
+    RUN_SEARCH_WORKERS = int(os.getenv("RUN_SEARCH_WORKERS", 16))
+    RUN_LISTING_CACHE_SECONDS = float(os.getenv("RUN_LISTING_CACHE_SECONDS", 30.0))
+    RUN_LISTING_CACHE_MAX_ENTRIES = int(os.getenv("RUN_LISTING_CACHE_MAX_ENTRIES", 20000))
+    # how long the retrieval buttons of a pathology search keep working
+    SEARCH_RESULT_TTL_SECONDS = int(os.getenv("SEARCH_RESULT_TTL_SECONDS", 86400))
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "postgresql://")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    BBM_CHUNK_ROWS = int(os.getenv("BBM_CHUNK_ROWS", 5000))
+    BBM_DOWNLOAD_TTL_SECONDS = int(os.getenv("BBM_DOWNLOAD_TTL_SECONDS", 86400))
+    # enriched files and uploads older than BBM_DOWNLOAD_TTL_SECONDS are removed this often
+    BBM_CLEANUP_SECONDS = int(os.getenv("BBM_CLEANUP_SECONDS", 3600))
+    SAMPLE_LOOKUP_CHUNK_SIZE = int(os.getenv("SAMPLE_LOOKUP_CHUNK_SIZE", 1000))
+    BULK_INSERT_BATCH_SIZE = int(os.getenv("BULK_INSERT_BATCH_SIZE", 1000))
+    PSEUDO_CACHE_MAX_ENTRIES = int(os.getenv("PSEUDO_CACHE_MAX_ENTRIES", 10000))
+    PSEUDO_CACHE_TTL_SECONDS = int(os.getenv("PSEUDO_CACHE_TTL_SECONDS", 3600))
+    # bounds how long another worker may still answer "not found" for a freshly inserted record
+    PSEUDO_CACHE_LOCAL_TTL_SECONDS = int(os.getenv("PSEUDO_CACHE_LOCAL_TTL_SECONDS", 60))
+    # prepended to the names of all Prometheus metrics, empty for none
+    METRICS_PREFIX = os.getenv("METRICS_PREFIX", "seq_services")
@@ -0,0 +1,262 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_COPY_CHUNK = 64 * 1024 * 1024
+# ioctl number of FICLONE from linux/fs.h
+_FICLONE = 0x40049409
+_LINK_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.EPERM, errno.EMLINK)
+
+LINK_MODES = ("copy", "reflink", "hardlink")
+
+
+class CopyStats:
+    """Files and bytes copied by one copy job, safe to update from worker threads"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.linked_files = 0
+        self.linked_bytes = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, size, linked=False):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            if linked:
+                self.linked_files += 1
+                self.linked_bytes += size
+
+    def merge(self, other):
+        with self._lock:
+            self.files += other.files
+            self.bytes += other.bytes
+            self.linked_files += other.linked_files
+            self.linked_bytes += other.linked_bytes
+
+    def stop(self):
+        self.finished = time.monotonic()
+
+    @property
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        """Bytes per second"""
+        return self.bytes / self.duration if self.duration > 0 else 0.0
+
+    def serialize(self):
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "linked_files": self.linked_files,
+            "linked_bytes": self.linked_bytes,
+            "duration_seconds": round(self.duration, 3),
+            "throughput_mb_s": round(self.throughput / 1024 / 1024, 2),
+        }
+
+
+class CopyManifest:
+    """Checkpoint of a resumable copy into a staging directory
+
+    Records source path, size and mtime and the size of the written copy for every file already
+    copied, so a restarted copy skips files whose source did not change since. The manifest is
+    rewritten atomically every flush_every files or flush_seconds seconds.
+    """
+    FILE_NAME = ".retrieval-manifest.json"
+    VERSION = 2
+
+    def __init__(self, staging_root, flush_every=100, flush_seconds=5.0):
+        self.path = os.path.join(staging_root, self.FILE_NAME)
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.files = {}
+        # written by an older layout of the staging directory, its content cannot be reused
+        self.stale = False
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.files = data["files"]
+            else:
+                self.stale = True
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def is_copied(self, src, dst, size, mtime_ns):
+        entry = self.files.get(dst)
+        if entry is None or entry[:3] != [src, size, mtime_ns]:
+            return False
+        try:
+            return os.path.getsize(dst) == entry[3]
+        except OSError:
+            return False
+
+    def record(self, src, dst, size, mtime_ns):
+        dst_size = os.path.getsize(dst)
+        with self._lock:
+            self.files[dst] = [src, size, mtime_ns, dst_size]
+            self._pending += 1
+            if self._pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.VERSION, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+
+def _kernel_copy(src_fd, dst_fd, size, on_chunk=None):
+    """Copies size bytes inside the kernel, returns False when neither copy_file_range nor sendfile works here"""
+    copied = 0
+    for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy is None:
+            continue
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    sent = os.sendfile(dst_fd, src_fd, copied, min(_COPY_CHUNK, size - copied))
+                else:
+                    sent = os.copy_file_range(src_fd, dst_fd, min(_COPY_CHUNK, size - copied), copied, copied)
+                if sent == 0:
+                    break
+                copied += sent
+                if on_chunk is not None:
+                    on_chunk()
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP) or copied:
+                raise
+    return False
+
+
+class Linker:
+    """Links files instead of copying them, as long as the filesystems allow it
+
+    "reflink" clones the file (FICLONE, copy-on-write, so /RUNS is never affected by changes of the copy),
+    "hardlink" shares the inode with the file in /RUNS. The first refusal of the filesystem
+    (different devices, no reflink support, ...) switches the linker off for the rest of the job.
+    """
+
+    def __init__(self, mode="copy"):
+        if mode not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {mode}, expected one of {LINK_MODES}")
+        self.mode = None if mode == "copy" else mode
+
+    def link(self, src, dst):
+        """Returns True when dst was linked to src, False when it has to be copied"""
+        mode = self.mode
+        if mode is None:
+            return False
+        try:
+            if mode == "hardlink":
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.link(src, dst)
+            else:
+                with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+            return True
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED:
+                raise
+            print(f"{mode} not possible for {src} -> {dst} ({e}), copying instead")
+            self.mode = None
+            return False
+
+
+def _stream_copy(fsrc, fdst, on_chunk=None):
+    while True:
+        chunk = fsrc.read(_COPY_CHUNK)
+        if not chunk:
+            return
+        fdst.write(chunk)
+        if on_chunk is not None:
+            on_chunk()
+
+
+def copy_file(src, dst, size, zero_copy_min_bytes, rewriter=None, on_chunk=None):
+    """Copies one file with its metadata (like shutil.copy2) and returns the number of copied bytes
+
+    Files with a rewriter are streamed through it, so pseudonyms are replaced while copying.
+    Other files of at least zero_copy_min_bytes are copied with os.copy_file_range (or os.sendfile),
+    so the data never passes through user space. on_chunk is called after every copied chunk of
+    those, so long copies of huge files can report that they are alive.
+    """
+    if rewriter is not None:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            rewriter.rewrite_stream(fsrc, fdst)
+        shutil.copystat(src, dst)
+    elif size >= zero_copy_min_bytes:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            if not _kernel_copy(fsrc.fileno(), fdst.fileno(), size, on_chunk):
+                _stream_copy(fsrc, fdst, on_chunk)
+        shutil.copystat(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return size
+
+
+def copy_files(pairs, workers=8, zero_copy_min_bytes=16 * 1024 * 1024, on_copied=None, link_mode="copy",
+               on_chunk=None):
+    """Copies files on a thread pool
+
+    Parameters
+    ----------
+    pairs : list of tuple
+        Source path, destination path, size and PseudonymRewriter (None to copy the content as is)
+        of every file, destination directories must exist
+    workers : int
+        Number of files copied at once
+    zero_copy_min_bytes : int
+        Files at least this large are copied inside the kernel (or linked, see link_mode)
+    on_copied : callable, optional
+        Called from the worker thread with the source path, destination path and size of every copied file
+    link_mode : str
+        "copy", or "reflink"/"hardlink" to link large files whose content is not rewritten, see Linker
+    on_chunk : callable, optional
+        Called from the worker thread after every chunk of a file copied inside the kernel
+
+    Returns
+    -------
+    CopyStats
+        Number of copied files and bytes and the copy duration
+    """
+    stats = CopyStats()
+    linker = Linker(link_mode)
+
+    def _copy(pair):
+        src, dst, size, rewriter = pair
+        if rewriter is None and size >= zero_copy_min_bytes and linker.link(src, dst):
+            stats.add(size, linked=True)
+        else:
+            stats.add(copy_file(src, dst, size, zero_copy_min_bytes, rewriter, on_chunk))
+        if on_copied is not None:
+            on_copied(src, dst, size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first failed copy
+        list(executor.map(_copy, pairs))
+
+    stats.stop()
+    return stats
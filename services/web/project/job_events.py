@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+
+from .redis_client import redis_client
+
+
+JOB_CHANNEL_PREFIX = "job:"
+# the latest event of a job is kept this long, for clients that start listening late
+_STATE_TTL_SECONDS = 24 * 3600
+# no event follows these
+TERMINAL_STATUSES = ("finished", "failed")
+
+
+def job_channel(job_id):
+    return f"{JOB_CHANNEL_PREFIX}{job_id}"
+
+
+def job_state_key(job_id):
+    return f"job_state:{job_id}"
+
+
+def publish_job_event(job_id, status, **fields):
+    """Publishes a JSON event on the job's Redis channel (consumed by /job-status/<job_id>) and
+    keeps it as the job's latest state"""
+    event = json.dumps({"job_id": job_id, "status": status, **fields})
+    pipe = redis_client.pipeline()
+    pipe.set(job_state_key(job_id), event, ex=_STATE_TTL_SECONDS)
+    pipe.publish(job_channel(job_id), event)
+    pipe.execute()
+
+
+class CopyProgress:
+    """Collects per-file progress of a copy job and publishes it at most once per min_interval seconds
+
+    Parameters
+    ----------
+    job_id : str
+        Job whose channel receives the events
+    files_total : int
+        Number of files the job copies
+    bytes_total : int
+        Number of bytes the job copies
+    min_interval : float
+        Minimal number of seconds between two published events
+    lease : RetrievalLease, optional
+        Claims of the job, renewed while bytes are moving
+    """
+
+    def __init__(self, job_id, files_total, bytes_total, min_interval=1.0, lease=None):
+        self.job_id = job_id
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.min_interval = min_interval
+        self.lease = lease
+        self.files_done = 0
+        self.bytes_done = 0
+        self.current = None
+        self.started = time.monotonic()
+        self._last_published = 0.0
+        self._lock = threading.Lock()
+
+    def _eta(self):
+        elapsed = time.monotonic() - self.started
+        if not self.bytes_done or elapsed <= 0:
+            return None
+        return round((self.bytes_total - self.bytes_done) / (self.bytes_done / elapsed), 1)
+
+    def _fields(self):
+        return {
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "current": self.current,
+            "eta_seconds": self._eta(),
+        }
+
+    def heartbeat(self):
+        """Called from the copy threads for every copied chunk, keeps the lease of the job alive"""
+        if self.lease is not None:
+            self.lease.keep_alive()
+
+    def copied(self, src, dst, size):
+        self.heartbeat()
+        with self._lock:
+            self.files_done += 1
+            self.bytes_done += size
+            now = time.monotonic()
+            if now - self._last_published < self.min_interval:
+                return
+            self._last_published = now
+            # published under the lock, so events of one job never arrive out of order
+            publish_job_event(self.job_id, "progress", **self._fields())
+
+    def start(self, current):
+        with self._lock:
+            self.current = current
+            self._last_published = time.monotonic()
+            publish_job_event(self.job_id, "progress", **self._fields())
+
+    def finish(self, **fields):
+        with self._lock:
+            publish_job_event(self.job_id, "finished", **{**self._fields(), **fields})
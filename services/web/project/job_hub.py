@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+import traceback
+
+import redis
+
+from .job_events import JOB_CHANNEL_PREFIX, job_state_key
+from .redis_client import redis_client
+
+
+class JobEventHub:
+    """Fans job events out to all /job-status streams of one web worker over a single pattern subscription
+
+    The subscriber runs in a background thread (a greenlet under the gevent workers), started by
+    the first subscribe. Every stream gets its own queue, so one Redis connection serves any number
+    of open streams.
+
+    Parameters
+    ----------
+    client : redis.Redis
+        Client decoding responses
+    reconnect_seconds : float
+        Pause before subscribing again after the connection was lost
+    """
+
+    def __init__(self, client, reconnect_seconds=1.0):
+        self.client = client
+        self.reconnect_seconds = reconnect_seconds
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, job_id):
+        """Returns a queue receiving the JSON events of the job, pass it to unsubscribe when done"""
+        events = queue.Queue()
+        with self._lock:
+            self._queues.setdefault(job_id, set()).add(events)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="job-event-hub", daemon=True)
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, job_id, events):
+        with self._lock:
+            queues = self._queues.get(job_id)
+            if queues is not None:
+                queues.discard(events)
+                if not queues:
+                    del self._queues[job_id]
+
+    def _fan_out(self, job_id, data):
+        with self._lock:
+            queues = list(self._queues.get(job_id, ()))
+        for events in queues:
+            events.put(data)
+
+    def _replay_latest(self):
+        with self._lock:
+            job_ids = list(self._queues)
+        if job_ids:
+            for job_id, data in zip(job_ids, self.client.mget([job_state_key(job_id) for job_id in job_ids])):
+                if data is not None:
+                    self._fan_out(job_id, data)
+
+    def _run(self):
+        while True:
+            pubsub = self.client.pubsub()
+            try:
+                pubsub.psubscribe(f"{JOB_CHANNEL_PREFIX}*")
+                # waits for the confirmation, the pattern receives every event published from then on
+                message = None
+                while message is None or message["type"] != "psubscribe":
+                    message = pubsub.get_message(timeout=self.reconnect_seconds)
+                # events published before the subscription (while it was down, or before the first
+                # stream of the worker started this thread) only survive as latest states
+                self._replay_latest()
+                for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self._fan_out(message["channel"][len(JOB_CHANNEL_PREFIX):], message["data"])
+            except redis.RedisError as e:
+                print(f"Job event subscription lost ({e}), subscribing again")
+                time.sleep(self.reconnect_seconds)
+            except Exception:
+                # the thread is the only subscriber of the process, it must not die on a bad message
+                traceback.print_exc()
+                time.sleep(self.reconnect_seconds)
+            finally:
+                pubsub.close()
+
+
+job_event_hub = JobEventHub(redis_client)
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+
+from .redis_client import redis_client
+
+_DEST_KEY = "retrieval:dest:{}"
+_SLOTS_KEY = "retrieval:slots:{}"
+
+# KEYS: destination keys, ARGV: job, ttl. Sets (or extends) the claim of the job on every destination
+# that is free or already its own, returns the holder of every destination.
+_CLAIM_DESTINATIONS = redis_client.register_script("""
+local holders = {}
+for i, key in ipairs(KEYS) do
+    local holder = redis.call('GET', key)
+    if not holder or holder == ARGV[1] then
+        redis.call('SET', key, ARGV[1], 'EX', ARGV[2])
+        holder = ARGV[1]
+    end
+    holders[i] = holder
+end
+return holders
+""")
+
+# KEYS: destination keys, ARGV: job. Deletes the claims that (still) belong to the job.
+_RELEASE_DESTINATIONS = redis_client.register_script("""
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        released = released + 1
+    end
+end
+return released
+""")
+
+# KEYS: slots of a storage, ARGV: job, now, ttl, limit. The sorted set is scored by the time every
+# slot expires, a job keeps (and extends) its slot or takes a free one.
+_ACQUIRE_COPY_SLOT = redis_client.register_script("""
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) or redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ttl)
+    return 1
+end
+return 0
+""")
+
+
+class LeaseLostError(Exception):
+    """A retrieval job did not renew its claims in time and another job took its destinations over"""
+
+
+def in_flight_job(dest):
+    """Returns the ID of the job currently retrieving dest, None when nobody does"""
+    return redis_client.get(_DEST_KEY.format(dest))
+
+
+def claim_destinations(job_id, destinations, ttl):
+    """Registers job_id as the job retrieving every destination nobody else retrieves yet
+
+    Claims job_id already holds are extended, the whole call is one atomic step.
+
+    Parameters
+    ----------
+    job_id : str
+        Job about to be started (or running)
+    destinations : list of str
+        Final paths in /RETRIEVED the job would create
+    ttl : int
+        Seconds after which the claims expire unless they are claimed again
+
+    Returns
+    -------
+    dict
+        Destination -> ID of the job retrieving it, job_id for the claimed ones
+    """
+    if not destinations:
+        return {}
+    holders = _CLAIM_DESTINATIONS(keys=[_DEST_KEY.format(dest) for dest in destinations], args=[job_id, ttl])
+    return dict(zip(destinations, holders))
+
+
+def release_destinations(job_id, destinations):
+    """Removes the claims of job_id, claims of other jobs are left alone"""
+    if destinations:
+        _RELEASE_DESTINATIONS(keys=[_DEST_KEY.format(dest) for dest in destinations], args=[job_id])
+
+
+def storage_key(path):
+    """Identifies the filesystem path lives on, jobs reading the same mount share its copy slots"""
+    return str(os.stat(path).st_dev)
+
+
+def acquire_copy_slot(storage, job_id, limit, ttl):
+    """Takes one of the limit parallel copy slots of a storage, returns False when all are taken
+
+    A slot expires ttl seconds after it was last acquired, acquiring a slot the job holds extends it.
+    """
+    return bool(_ACQUIRE_COPY_SLOT(keys=[_SLOTS_KEY.format(storage)], args=[job_id, time.time(), ttl, limit]))
+
+
+def release_copy_slot(storage, job_id):
+    redis_client.zrem(_SLOTS_KEY.format(storage), job_id)
+
+
+class RetrievalLease:
+    """Claims of a running retrieval job on its destinations and on a copy slot of its storage
+
+    The claims expire ttl seconds after their last renewal, so the destinations and the slot of a
+    killed worker are free again shortly after. keep_alive is called while bytes are moving (see
+    CopyProgress) and renews at most every ttl / 3 seconds.
+
+    Parameters
+    ----------
+    job_id : str
+        Running job
+    destinations : list of str
+        Final paths in /RETRIEVED the job creates
+    storage : str
+        storage_key of the paths the job copies from
+    ttl : int
+        Lifetime of the claims in seconds
+    slot_limit : int
+        Number of jobs copying from the storage at once
+    """
+
+    def __init__(self, job_id, destinations, storage, ttl, slot_limit):
+        self.job_id = job_id
+        self.destinations = destinations
+        self.storage = storage
+        self.ttl = ttl
+        self.slot_limit = slot_limit
+        self.has_slot = False
+        self._renewed = 0.0
+        self._lock = threading.Lock()
+
+    def claim(self):
+        """Claims (or extends the claims on) the destinations, returns the ones held by other jobs"""
+        holders = claim_destinations(self.job_id, self.destinations, self.ttl)
+        self._renewed = time.monotonic()
+        return [dest for dest, holder in holders.items() if holder != self.job_id]
+
+    def acquire_slot(self):
+        self.has_slot = acquire_copy_slot(self.storage, self.job_id, self.slot_limit, self.ttl)
+        return self.has_slot
+
+    def keep_alive(self):
+        """Renews the claims and the slot when a third of their lifetime has passed, thread safe
+
+        Raises LeaseLostError when a destination was taken over by another job meanwhile.
+        """
+        with self._lock:
+            if time.monotonic() - self._renewed < self.ttl / 3:
+                return
+            lost = self.claim()
+            if self.has_slot:
+                # a slot lost to an expiry is taken again when there is room, the copy goes on either way
+                acquire_copy_slot(self.storage, self.job_id, self.slot_limit, self.ttl)
+        if lost:
+            raise LeaseLostError(f"Job {self.job_id} lost its claim on {', '.join(lost)} to another job")
+
+    def release(self):
+        """Frees the slot and the destinations still claimed by the job"""
+        release_copy_slot(self.storage, self.job_id)
+        release_destinations(self.job_id, self.destinations)
@@ -0,0 +1,118 @@
+import glob
+import os
+import time
+
+from celery.signals import task_postrun, task_prerun
+from flask import g, request
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .app import app
+
+# Under gunicorn and celery every process records into its own files in PROMETHEUS_MULTIPROC_DIR
+# (set before the first import of prometheus_client). The files are named by PID, so every container
+# gets its own subdirectory of the shared metrics volume, /metrics sums up the files of all of them.
+_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+_PREFIX = app.config["METRICS_PREFIX"]
+
+# retrievals and enrichments run for minutes to hours
+_JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, float("inf"))
+_DB_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def _name(name):
+    return f"{_PREFIX}_{name}" if _PREFIX else name
+
+
+HTTP_REQUEST_SECONDS = Histogram(_name("http_request_duration_seconds"),
+                                 "Time until the response of a request is returned (streams are not included)",
+                                 ["method", "endpoint", "status"])
+DB_QUERY_SECONDS = Histogram(_name("db_query_duration_seconds"), "Execution of one SQL statement", ["statement"])
+FIND_FILE_SECONDS = Histogram(_name("find_file_duration_seconds"), "Locating the sample folders of one search in /RUNS",
+                              ["source"])
+CELERY_TASK_SECONDS = Histogram(_name("celery_task_duration_seconds"), "Run time of a Celery task",
+                                ["task", "state"], buckets=_JOB_BUCKETS)
+COPY_BYTES = Counter(_name("copy_bytes"), "Bytes retrieved from /RUNS, by whether they were copied or linked",
+                     ["method"])
+COPY_SECONDS = Histogram(_name("copy_duration_seconds"), "Copying all runs or samples of one retrieval job",
+                         ["link_mode"], buckets=_JOB_BUCKETS)
+RENAME_SECONDS = Histogram(_name("rename_duration_seconds"),
+                           "Planning one retrieval job, which maps every pseudonymized folder and file to its final name",
+                           buckets=_JOB_BUCKETS)
+
+
+class _ContainersCollector:
+    """Merges the metric files of every container writing into the metrics volume"""
+
+    def __init__(self, multiproc_dir):
+        self.pattern = os.path.join(os.path.dirname(os.path.abspath(multiproc_dir)), "*", "*.db")
+
+    def collect(self):
+        return multiprocess.MultiProcessCollector.merge(glob.glob(self.pattern), accumulate=True)
+
+
+def latest_metrics():
+    """Metrics of all processes in the text exposition format"""
+    if _MULTIPROC_DIR is None:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    registry.register(_ContainersCollector(_MULTIPROC_DIR))
+    return generate_latest(registry)
+
+
+def observe_copy(stats, link_mode):
+    """Records the CopyStats of a finished retrieval job"""
+    COPY_BYTES.labels("linked").inc(stats.linked_bytes)
+    COPY_BYTES.labels("copied").inc(stats.bytes - stats.linked_bytes)
+    COPY_SECONDS.labels(link_mode).observe(stats.duration)
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        # the route name, not the path, keeps the number of label values bounded
+        HTTP_REQUEST_SECONDS.labels(request.method, request.endpoint or "unmatched",
+                                    response.status_code).observe(time.perf_counter() - started)
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _observe_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    statement_type = (statement.split(None, 1) or [""])[0].upper()
+    DB_QUERY_SECONDS.labels(statement_type if statement_type in _DB_STATEMENTS else "OTHER").observe(
+        time.perf_counter() - started)
+
+
+@event.listens_for(Engine, "handle_error")
+def _drop_query_timer(context):
+    # failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+
+_task_started = {}
+
+
+@task_prerun.connect
+def _start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def _observe_task(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_SECONDS.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
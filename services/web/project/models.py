@@ -0,0 +1,72 @@
+from .app import db
+
+
+class PatientPseudo(db.Model):
+    __tablename__ = "patient_pseudonymization"
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.String(128), unique=True, index=True)
+    patient_pseudo_id = db.Column(db.String(128), index=True)
+
+    def __init__(self, patient_id, patient_pseudo_id):
+        self.patient_id = patient_id
+        self.patient_pseudo_id = patient_pseudo_id
+
+    @property
+    def serialize(self):
+        return {
+            "ID": self.id,
+            "patient_ID": self.patient_id,
+            "patient_pseudo_ID": self.patient_pseudo_id
+        }
+
+
+class PredictivePseudo(db.Model):
+    __tablename__ = "predictive_pseudonymization"
+    id = db.Column(db.Integer, primary_key=True)
+    predictive_id = db.Column(db.String(128), unique=True, index=True)
+    predictive_id_unified = db.Column(db.String(128), index=True)
+    predictive_pseudo_id = db.Column(db.String(128), index=True)
+    # parts of predictive_id_unified (see predictive_number.normalize), the base is shared by all variants
+    predictive_base = db.Column(db.String(128))
+    predictive_suffix = db.Column(db.String(128))
+    predictive_year = db.Column(db.Integer, index=True)
+    __table_args__ = (
+        # pattern ops, so prefix searches (LIKE '2022_1%') use the index on Postgres as well
+        db.Index("ix_predictive_pseudonymization_predictive_base", "predictive_base",
+                 postgresql_ops={"predictive_base": "varchar_pattern_ops"}),
+    )
+
+    def __init__(self, predictive_id, predictive_id_unified, predictive_pseudo_id):
+        self.predictive_id = predictive_id
+        self.predictive_id_unified = predictive_id_unified
+        self.predictive_pseudo_id = predictive_pseudo_id
+
+    @property
+    def serialize(self):
+        return {
+            "predictive_ID": self.predictive_id,
+            "predictive_ID_unified": self.predictive_id_unified,
+            "predictive_pseudo_ID": self.predictive_pseudo_id,
+            "predictive_base": self.predictive_base,
+            "predictive_suffix": self.predictive_suffix,
+            "predictive_year": self.predictive_year
+        }
+
+
+class SamplePseudo(db.Model):
+    __tablename__ = "sample_pseudonymization"
+    id = db.Column(db.Integer, primary_key=True)
+    sample_id = db.Column(db.String(128), unique=True, index=True)
+    sample_pseudo_id = db.Column(db.String(128), index=True)
+
+    def __init__(self, sample_id, sample_pseudo_id):
+        self.sample_id = sample_id
+        self.sample_pseudo_id = sample_pseudo_id
+
+    @property
+    def serialize(self):
+        return {
+            "id": self.id,
+            "sample_ID": self.sample_id,
+            "sample_pseudo_ID": self.sample_pseudo_id
+        }
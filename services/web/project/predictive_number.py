@@ -0,0 +1,117 @@
+import re
+from collections import namedtuple
+
+from .app import db
+from .models import PredictivePseudo
+
+
+def _year_first(year, number, suffix):
+    return year + "_" + number + suffix
+
+
+def _number_first(year, number, suffix):
+    # kept as the legacy normalization wrote it: 1234-22_RNA -> 2022_RNA_1234
+    return year + suffix + "_" + number
+
+
+Rule = namedtuple("Rule", "name pattern century unify")
+
+# Checked in this order, the first matching rule wins. 22-1234 matches both the year-first and the
+# number-first layout (as does 12-22), the year-first rules come first and take it.
+# Patterns are anchored at both ends by _COMBINED.
+RULES = (
+    Rule("year-number", r"(?P<year>20[1-2]\d)-(?P<number>\d+)(?P<suffix>.*)", "", _year_first),
+    Rule("yy-number", r"(?P<year>[1-2]\d)-(?P<number>\d+)(?P<suffix>.*)", "20", _year_first),
+    Rule("number-yy", r"(?P<number>\d{1,4})-(?P<year>[1-2]\d)(?P<suffix>.*)", "20", _number_first),
+    Rule("yy_number", r"(?P<year>[1-2]\d)_(?P<number>\d+)(?P<suffix>.*)", "20", _year_first),
+    # already unified, e.g. a number entered into the search form
+    Rule("unified", r"(?P<year>(?:19|20)\d{2})_(?P<number>\d+)(?P<suffix>.*)", "", _year_first),
+)
+
+
+def _numbered(pattern, i):
+    for group in ("year", "number", "suffix"):
+        pattern = pattern.replace(f"(?P<{group}>", f"(?P<{group}{i}>")
+    return pattern
+
+
+# all rules in one alternation, tried left to right like the table, so a value is scanned once
+_COMBINED = re.compile(
+    "^(?:" + "|".join(f"(?P<rule{i}>{_numbered(rule.pattern, i)})" for i, rule in enumerate(RULES)) + r")\Z",
+    re.S
+)
+# index of the rule group -> rule and indexes of its year, number and suffix groups
+_RULE_GROUPS = {
+    _COMBINED.groupindex[f"rule{i}"]: (rule, tuple(_COMBINED.groupindex[f"{group}{i}"] for group in ("year", "number", "suffix")))
+    for i, rule in enumerate(RULES)
+}
+
+
+class PredictiveNumber(namedtuple("PredictiveNumber", "unified year number suffix rule")):
+    """Normalized predictive number
+
+    unified is the <year>_<number><suffix> form stored in predictive_id_unified, year (int),
+    number and suffix are None/"" and rule is None for numbers no rule recognizes.
+    """
+
+    @property
+    def base(self):
+        """<year>_<number> shared by all variants (_RNA, _DNA, A, II, r, ...) of one predictive number"""
+        return self.unified if self.year is None else f"{self.year}_{self.number}"
+
+    @property
+    def index_columns(self):
+        return {
+            "predictive_base": self.base,
+            # stored without its separating underscore
+            "predictive_suffix": self.suffix.lstrip("_"),
+            "predictive_year": self.year,
+        }
+
+
+def normalize(pred_number):
+    """Normalizes one predictive number with the first matching rule of RULES"""
+    match = _COMBINED.match(pred_number)
+    if match is None:
+        return PredictiveNumber(pred_number, None, None, "", None)
+    # the rule group closes after its year, number and suffix groups, so it is the last matched one
+    rule, groups = _RULE_GROUPS[match.lastindex]
+    year, number, suffix = match.group(*groups)
+    year = rule.century + year
+    # skips the Python-level __new__ of namedtuple, a noticeable share of the cost per value
+    return tuple.__new__(PredictiveNumber, (rule.unify(year, number, suffix), int(year), number, suffix, rule.name))
+
+
+def normalize_many(values):
+    """normalize for a whole batch (e.g. of a bulk load), every distinct value is normalized once"""
+    normalized = {value: normalize(value) for value in set(values)}
+    return [normalized[value] for value in values]
+
+
+def backfill_predictive_index(batch_size=1000, recompute=False):
+    """Fills predictive_id_unified, predictive_base, predictive_suffix and predictive_year from
+    predictive_id, for rows inserted before these columns existed (every row with recompute)
+
+    Returns
+    -------
+    int
+        Number of updated rows
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        query = db.select(PredictivePseudo.id, PredictivePseudo.predictive_id).where(PredictivePseudo.id > last_id)
+        if not recompute:
+            query = query.where(PredictivePseudo.predictive_base.is_(None))
+        rows = db.session.execute(query.order_by(PredictivePseudo.id).limit(batch_size)).all()
+        if not rows:
+            return updated
+
+        numbers = normalize_many([pred_id or "" for _, pred_id in rows])
+        db.session.execute(db.update(PredictivePseudo), [
+            {"id": row_id, "predictive_id_unified": number.unified, **number.index_columns}
+            for (row_id, _), number in zip(rows, numbers)
+        ])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1][0]
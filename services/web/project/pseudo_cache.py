@@ -0,0 +1,150 @@
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+
+_MISSING = object()
+# stored for keys the database does not know, so repeated lookups of unknown IDs are cached too
+_NOT_FOUND = "null"
+
+
+class PseudonymCache:
+    """Read-through cache of pseudonymization records: a bounded per-process LRU in front of Redis
+
+    Values are the serialized records (None for unknown keys). Records are never updated once
+    inserted, so invalidation (on insert) only has to drop cached "not found" entries. Other
+    processes keep their local entries until local_ttl_seconds passes.
+
+    Parameters
+    ----------
+    redis_client : redis.Redis
+        Shared cache tier, decoding responses
+    max_entries : int
+        Size of the per-process LRU
+    ttl_seconds : int
+        Lifetime of Redis entries
+    local_ttl_seconds : int
+        Lifetime of per-process entries
+    prefix : str
+        Prefix of the Redis keys
+    """
+
+    def __init__(self, redis_client, max_entries=10000, ttl_seconds=3600, local_ttl_seconds=60, prefix="pseudo_cache"):
+        self.redis = redis_client
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.local_ttl_seconds = local_ttl_seconds
+        self.prefix = prefix
+        self.counters = Counter()
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, table, column, value):
+        return f"{self.prefix}:{table}:{column}:{value}"
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return _MISSING
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_ttl_seconds, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def _count(self, tier, n, shared=True):
+        if n:
+            with self._lock:
+                self.counters[tier] += n
+            # local hits are not shared, they must not cost a round trip to Redis
+            if shared:
+                self.redis.hincrby(f"{self.prefix}:stats", tier, n)
+
+    def get_many(self, table, column, values, load):
+        """Looks up records by column, going to the database only for values neither tier knows
+
+        Parameters
+        ----------
+        table : str
+            Table name
+        column : str
+            Looked up column
+        values : iterable of str
+            Looked up values
+        load : callable
+            Called with the list of uncached values, returns value -> serialized record
+            for the values found in the database
+
+        Returns
+        -------
+        dict
+            Value -> serialized record, None for unknown values
+        """
+        found = {}
+        remote = []
+        for value in dict.fromkeys(values):
+            cached = self._get_local(self._key(table, column, value))
+            if cached is _MISSING:
+                remote.append(value)
+            else:
+                found[value] = cached
+        self._count("local_hits", len(found), shared=False)
+        if not remote:
+            return found
+
+        missing = []
+        for value, cached in zip(remote, self.redis.mget([self._key(table, column, value) for value in remote])):
+            if cached is None:
+                missing.append(value)
+            else:
+                found[value] = json.loads(cached)
+                self._set_local(self._key(table, column, value), found[value])
+        self._count("redis_hits", len(remote) - len(missing))
+        self._count("misses", len(missing))
+        if not missing:
+            return found
+
+        loaded = load(missing)
+        pipe = self.redis.pipeline()
+        for value in missing:
+            record = loaded.get(value)
+            found[value] = record
+            key = self._key(table, column, value)
+            self._set_local(key, record)
+            pipe.set(key, _NOT_FOUND if record is None else json.dumps(record), ex=self.ttl_seconds)
+        pipe.execute()
+        return found
+
+    def invalidate(self, table, rows):
+        """Drops the cached entries of every column value of the inserted rows"""
+        keys = [self._key(table, column, value) for row in rows for column, value in row.items()]
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        if keys:
+            self.redis.delete(*keys)
+
+    def clear(self):
+        """Drops every cached entry, e.g. after a bulk import"""
+        with self._lock:
+            self._local.clear()
+        pipe = self.redis.pipeline()
+        for key in self.redis.scan_iter(f"{self.prefix}:*:*:*", count=1000):
+            pipe.delete(key)
+        pipe.execute()
+
+    def stats(self):
+        """Hit and miss counters of this process, and Redis hits and misses of all processes sharing Redis"""
+        with self._lock:
+            local = {"local_hits": 0, "redis_hits": 0, "misses": 0, **self.counters, "local_entries": len(self._local)}
+        shared = {tier: int(n) for tier, n in self.redis.hgetall(f"{self.prefix}:stats").items()}
+        return {"process": local, "shared": shared}
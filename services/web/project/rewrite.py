@@ -0,0 +1,68 @@
+import re
+import shutil
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class PseudonymRewriter:
+    """Replaces all pseudonyms with their predictive numbers in a single pass
+
+    All pseudonyms are compiled into one alternation regex (longest first, so a pseudonym that
+    is a prefix of another one never wins), so the cost of a pass does not grow with the number
+    of samples in a run.
+
+    Parameters
+    ----------
+    replacements : dict
+        Pseudonym -> predictive number
+    """
+
+    def __init__(self, replacements):
+        self.replacements = {old: new for old, new in replacements.items() if old}
+        patterns = sorted(self.replacements, key=len, reverse=True)
+        self.max_len = max((len(p.encode()) for p in patterns), default=0)
+        self._bytes_replacements = {old.encode(): new.encode() for old, new in self.replacements.items()}
+        self._regex = re.compile("|".join(map(re.escape, patterns))) if patterns else None
+        self._bytes_regex = re.compile(b"|".join(re.escape(p.encode()) for p in patterns)) if patterns else None
+
+    def rewrite_name(self, name):
+        if self._regex is None:
+            return name
+        return self._regex.sub(lambda m: self.replacements[m.group()], name)
+
+    def _rewrite_buffer(self, buf, final):
+        """Returns (rewritten bytes, unprocessed tail, number of replacements)
+
+        Matches starting in the last max_len - 1 bytes are left for the next chunk,
+        as a longer pseudonym could still continue there.
+        """
+        safe_end = len(buf) if final else len(buf) - (self.max_len - 1)
+        out = []
+        pos = 0
+        count = 0
+        for match in self._bytes_regex.finditer(buf):
+            if match.start() >= safe_end:
+                break
+            out.append(buf[pos:match.start()])
+            out.append(self._bytes_replacements[match.group()])
+            pos = match.end()
+            count += 1
+        keep_from = max(pos, safe_end)
+        out.append(buf[pos:keep_from])
+        return b"".join(out), buf[keep_from:], count
+
+    def rewrite_stream(self, fsrc, fdst):
+        """Streams fsrc into fdst in bounded memory, returns the number of replacements"""
+        if self._bytes_regex is None:
+            shutil.copyfileobj(fsrc, fdst, _CHUNK_SIZE)
+            return 0
+
+        carry = b""
+        count = 0
+        while True:
+            chunk = fsrc.read(_CHUNK_SIZE)
+            data, carry, replaced = self._rewrite_buffer(carry + chunk, final=not chunk)
+            fdst.write(data)
+            count += replaced
+            if not chunk:
+                return count
@@ -0,0 +1,299 @@
+import os
+import re
+import time
+import zlib
+
+from .app import db
+
+YEAR_PATTERN = re.compile(r'^(19|20)\d{2}$')
+MISEQ_SUBDIRS = ["complete-runs", "mamma-print", "missing-analysis"]
+
+
+class RunSample(db.Model):
+    __tablename__ = "run_sample_index"
+    id = db.Column(db.Integer, primary_key=True)
+    sample_pseudo_id = db.Column(db.String(128), index=True)
+    sample_path = db.Column(db.String(1024))
+    run_path = db.Column(db.String(1024), index=True)
+    sequencer_type = db.Column(db.String(16))
+    year = db.Column(db.String(4))
+
+    def __init__(self, sample_pseudo_id, sample_path, run_path, sequencer_type, year):
+        self.sample_pseudo_id = sample_pseudo_id
+        self.sample_path = sample_path
+        self.run_path = run_path
+        self.sequencer_type = sequencer_type
+        self.year = year
+
+
+class IndexedDirectory(db.Model):
+    """Directory of the OrganisedRuns tree seen by the last index refresh
+
+    Run containers (MiSEQ/<subdir>, NextSeq) have no parent, runs point to their container.
+    For runs mtime is the mtime of their Samples folder (None if it does not exist yet).
+    """
+    __tablename__ = "run_index_directory"
+    path = db.Column(db.String(1024), primary_key=True)
+    parent = db.Column(db.String(1024), index=True)
+    sequencer_type = db.Column(db.String(16))
+    year = db.Column(db.String(4))
+    mtime = db.Column(db.Float)
+    discovered_at = db.Column(db.Float)
+
+
+def iter_year_dirs(path):
+    for name in os.listdir(path):
+        if YEAR_PATTERN.match(name) and os.path.isdir(os.path.join(path, name)):
+            yield name, os.path.join(path, name)
+
+
+def iter_run_containers(full_year_path):
+    """Yields (sequencer_type, path) of every directory inside a year folder that holds runs"""
+    for sequence_type in os.listdir(full_year_path):
+        match sequence_type:
+            case "MiSEQ":
+                for subdir in MISEQ_SUBDIRS:
+                    miseq_path = os.path.join(full_year_path, "MiSEQ", subdir)
+                    if os.path.exists(miseq_path):
+                        yield "MiSEQ", miseq_path
+            case "NextSeq":
+                nextseq_path = os.path.join(full_year_path, "NextSeq")
+                if os.path.exists(nextseq_path):
+                    yield "NextSeq", nextseq_path
+            case _:
+                continue  # Skip any sequence_type that is not MiSEQ or NextSeq
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _run_rows(year, sequencer_type, run_path):
+    sample_dir = os.path.join(run_path, "Samples")
+    return [
+        {
+            "sample_pseudo_id": sample,
+            "sample_path": os.path.join(sample_dir, sample),
+            "run_path": run_path,
+            "sequencer_type": sequencer_type,
+            "year": year,
+        }
+        for sample in os.listdir(sample_dir)
+    ]
+
+
+class _IndexRefresh:
+    def __init__(self, settle_seconds, batch_size, sweep_passes=1, pass_number=0):
+        self.settle_seconds = settle_seconds
+        self.batch_size = batch_size
+        self.sweep_passes = max(1, sweep_passes)
+        self.pass_number = pass_number
+        self.now = time.time()
+        self.known = {entry.path: entry for entry in db.session.execute(db.select(IndexedDirectory)).scalars()}
+        self.children = {}
+        for entry in self.known.values():
+            if entry.parent is not None:
+                self.children.setdefault(entry.parent, []).append(entry)
+        self.rows = []
+        self.stats = {"directories_visited": 0, "runs_rescanned": 0, "runs_removed": 0}
+
+    def _is_recent(self, timestamp):
+        return timestamp is not None and self.now - timestamp < self.settle_seconds
+
+    def _is_due(self, run):
+        """Whether the Samples folder of a known run is checked in this pass
+
+        Runs that changed within settle_seconds (or have no Samples folder yet) are checked on every
+        pass, the settled ones in turns, each once per sweep_passes passes.
+        """
+        if run.mtime is None or self._is_recent(run.mtime):
+            return True
+        return zlib.crc32(run.path.encode()) % self.sweep_passes == self.pass_number % self.sweep_passes
+
+    def _flush(self, force=False):
+        if self.rows and (force or len(self.rows) >= self.batch_size):
+            db.session.execute(db.insert(RunSample), self.rows)
+            self.rows = []
+
+    def _remove_run(self, entry):
+        db.session.execute(db.delete(RunSample).where(RunSample.run_path == entry.path))
+        db.session.delete(entry)
+        self.stats["runs_removed"] += 1
+
+    def _refresh_run(self, year, sequencer_type, container, run_path):
+        self.stats["directories_visited"] += 1
+        mtime = _mtime(os.path.join(run_path, "Samples"))
+        entry = self.known.get(run_path)
+        if entry is not None and entry.mtime == mtime:
+            return
+
+        if entry is None:
+            entry = IndexedDirectory(path=run_path, parent=container, sequencer_type=sequencer_type,
+                                     year=year, discovered_at=self.now)
+            db.session.add(entry)
+        else:
+            db.session.execute(db.delete(RunSample).where(RunSample.run_path == run_path))
+        entry.mtime = mtime
+
+        if mtime is not None:
+            self.rows.extend(_run_rows(year, sequencer_type, run_path))
+            self._flush()
+        self.stats["runs_rescanned"] += 1
+
+    def _refresh_container(self, year, sequencer_type, container):
+        self.stats["directories_visited"] += 1
+        mtime = _mtime(container)
+        entry = self.known.get(container)
+        known_runs = self.children.get(container, [])
+
+        if entry is not None and entry.mtime == mtime and not self._is_recent(mtime):
+            # no run was added or removed, but samples added to a run only change its Samples folder,
+            # _refresh_run stats it and rescans the run when it changed
+            for run in known_runs:
+                if self._is_due(run):
+                    self._refresh_run(year, sequencer_type, container, run.path)
+            return
+
+        on_disk = {os.path.join(container, run) for run in os.listdir(container)}
+        for run_path in on_disk:
+            run = self.known.get(run_path)
+            if (run is None and os.path.isdir(run_path)) or (run is not None and self._is_due(run)):
+                self._refresh_run(year, sequencer_type, container, run_path)
+        for run in known_runs:
+            if run.path not in on_disk:
+                self._remove_run(run)
+
+        if entry is None:
+            entry = IndexedDirectory(path=container, parent=None, sequencer_type=sequencer_type,
+                                     year=year, discovered_at=self.now)
+            db.session.add(entry)
+        entry.mtime = mtime
+
+    def run(self, path):
+        start = time.monotonic()
+        seen_containers = set()
+        self.stats["directories_visited"] += 1
+        for year, full_year_path in iter_year_dirs(path):
+            self.stats["directories_visited"] += 1
+            for sequencer_type, container in iter_run_containers(full_year_path):
+                seen_containers.add(container)
+                self._refresh_container(year, sequencer_type, container)
+
+        for entry in list(self.known.values()):
+            if entry.parent is None and entry.path not in seen_containers:
+                for run in self.children.get(entry.path, []):
+                    self._remove_run(run)
+                db.session.delete(entry)
+
+        self._flush(force=True)
+        db.session.commit()
+        self.stats["duration_seconds"] = round(time.monotonic() - start, 3)
+        self.stats["indexed_samples"] = db.session.execute(db.select(db.func.count(RunSample.id))).scalar_one()
+        return self.stats
+
+
+def refresh_run_index(path, settle_seconds=86400, batch_size=5000, sweep_passes=1, pass_number=0):
+    """Brings the run index up to date by rescanning only directories whose mtime changed
+
+    Run containers are listed only when their mtime changed (or is younger than settle_seconds).
+    The Samples folders of runs changed within settle_seconds are stat'ed on every refresh, those of
+    older runs are spread over sweep_passes refreshes, so a refresh costs about as much as the recent
+    runs. Runs are rescanned only when the mtime of their Samples folder changed.
+
+    Parameters
+    ----------
+    path : str
+        Root of the OrganisedRuns tree (/RUNS inside the containers)
+    settle_seconds : int
+        How long a changed container or run keeps being checked on every refresh
+    batch_size : int
+        Number of rows sent to the database in one INSERT
+    sweep_passes : int
+        Number of refreshes sharing the checks of the settled runs, 1 checks all of them
+    pass_number : int
+        Number of this refresh (e.g. the time divided by the refresh interval), picks the settled runs it checks
+
+    Returns
+    -------
+    dict
+        Scan statistics (duration_seconds, directories_visited, runs_rescanned, runs_removed, indexed_samples)
+    """
+    if db.session.execute(db.select(IndexedDirectory.path).limit(1)).first() is None:
+        # index built without directory bookkeeping, start from scratch
+        db.session.execute(db.delete(RunSample))
+    return _IndexRefresh(settle_seconds, batch_size, sweep_passes, pass_number).run(path)
+
+
+def build_run_index(path, batch_size=5000):
+    """Rebuilds the whole run index from scratch by walking the OrganisedRuns tree once
+
+    Parameters
+    ----------
+    path : str
+        Root of the OrganisedRuns tree (/RUNS inside the containers)
+    batch_size : int
+        Number of rows sent to the database in one INSERT
+
+    Returns
+    -------
+    dict
+        Scan statistics, see refresh_run_index
+    """
+    db.session.execute(db.delete(RunSample))
+    db.session.execute(db.delete(IndexedDirectory))
+    return refresh_run_index(path, batch_size=batch_size)
+
+
+def run_index_is_empty():
+    return db.session.execute(db.select(RunSample.id).limit(1)).first() is None
+
+
+def lookup_sample_paths(sample_pseudo_ids):
+    """Sample folders of all pseudonyms in one query, None for pseudonyms not in the index"""
+    paths = dict.fromkeys(sample_pseudo_ids)
+    rows = db.session.execute(
+        db.select(RunSample.sample_pseudo_id, RunSample.sample_path)
+        .filter(RunSample.sample_pseudo_id.in_(list(paths)))
+        .order_by(RunSample.id)
+    )
+    for sample_pseudo_id, sample_path in rows:
+        if paths[sample_pseudo_id] is None:
+            paths[sample_pseudo_id] = sample_path
+    return paths
+
+
+def find_unindexed_samples(sample_pseudo_ids, settle_seconds=86400):
+    """Sample folders of pseudonyms added to /RUNS since the last refresh, None for the others
+
+    Only directories that changed since the refresh read them are listed: new runs of run
+    containers whose mtime changed and runs changed within settle_seconds whose Samples folder
+    changed. Samples added to older runs are left to the refresh.
+    """
+    wanted = set(sample_pseudo_ids)
+    recent = db.select(IndexedDirectory).where(db.or_(
+        IndexedDirectory.parent.is_(None), IndexedDirectory.mtime.is_(None),
+        IndexedDirectory.mtime >= time.time() - settle_seconds))
+    changed_runs = []
+    for entry in db.session.execute(recent).scalars().all():
+        if entry.parent is not None:
+            if _mtime(os.path.join(entry.path, "Samples")) != entry.mtime:
+                changed_runs.append(entry.path)
+        elif _mtime(entry.path) not in (entry.mtime, None):
+            known = set(db.session.execute(
+                db.select(IndexedDirectory.path).where(IndexedDirectory.parent == entry.path)).scalars())
+            changed_runs.extend(run_path for run_path in (os.path.join(entry.path, run) for run in os.listdir(entry.path))
+                                if run_path not in known)
+
+    found = {}
+    for run_path in changed_runs:
+        sample_dir = os.path.join(run_path, "Samples")
+        try:
+            samples = os.listdir(sample_dir)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for name in wanted.intersection(samples):
+            found.setdefault(name, os.path.join(sample_dir, name))
+    return {pseudonym: found.get(pseudonym) for pseudonym in sample_pseudo_ids}
@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from gevent import monkey
+from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+
+from .run_index import iter_run_containers, iter_year_dirs
+
+
+def _year_paths(path):
+    return tuple(full_year_path for _, full_year_path in iter_year_dirs(path))
+
+
+def _container_paths(full_year_path):
+    return tuple(container for _, container in iter_run_containers(full_year_path))
+
+
+def _run_paths(container):
+    return tuple(os.path.join(container, run) for run in os.listdir(container))
+
+
+def _sample_names(run_path):
+    try:
+        return tuple(os.listdir(os.path.join(run_path, "Samples")))
+    except (FileNotFoundError, NotADirectoryError):
+        # run without Samples (yet)
+        return ()
+
+
+# OrganisedRuns/<year>/<MiSEQ/subdir or NextSeq>/<run>/Samples/<sample>, each level lists the paths of the next one
+_LEVELS = (_year_paths, _container_paths, _run_paths, _sample_names)
+
+
+class ListingCache:
+    """Directory listings of the OrganisedRuns tree, shared by all searches of a process for ttl_seconds
+
+    Parameters
+    ----------
+    ttl_seconds : float
+        Lifetime of a listing, new runs and samples are found at most this much later
+    max_entries : int
+        Number of kept listings, the least recently used ones are dropped first
+    """
+
+    def __init__(self, ttl_seconds=30, max_entries=20000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, level, path):
+        key = (level, path)
+        with self._lock:
+            entry = self._listings.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._listings.move_to_end(key)
+                return entry[1]
+
+        # listed outside of the lock, two searches listing the same directory at once both get it right
+        listing = _LEVELS[level](path)
+        with self._lock:
+            self._listings[key] = (time.monotonic() + self.ttl_seconds, listing)
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.max_entries:
+                self._listings.popitem(last=False)
+        return listing
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+class RunSearch:
+    """Finds sample folders in the OrganisedRuns tree while the run index is not built
+
+    All pseudonyms of a request are resolved in one traversal that lists every directory at most
+    once. Listings of independent directories run concurrently, so the latency of the network
+    mount is overlapped. Under gevent the listings run in gevent's pool of real threads, they
+    would block the whole worker otherwise.
+
+    Parameters
+    ----------
+    workers : int
+        Number of directories listed at once
+    cache : ListingCache
+        Listings shared with other searches
+    """
+
+    def __init__(self, workers=16, cache=None):
+        self.workers = workers
+        self.cache = cache if cache is not None else ListingCache()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        # created on first use, in the (forked and patched) worker process
+        with self._lock:
+            if self._executor is None:
+                if monkey.is_module_patched("threading"):
+                    self._executor = GeventThreadPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="run-search")
+            return self._executor
+
+    def list_samples(self, run_path):
+        """Names of the sample folders of a run, from the listings shared with the searches"""
+        return self.cache.get(len(_LEVELS) - 1, run_path)
+
+    def find(self, path, pseudonyms):
+        """Paths of the sample folders named by pseudonyms
+
+        The traversal stops as soon as every pseudonym is found, a pseudonym names a sample of one run.
+
+        Returns
+        -------
+        dict
+            Pseudonym -> sample folder, None for pseudonyms not found
+        """
+        wanted = set(pseudonyms)
+        found = {}
+        pool = self._pool()
+        pending = {}
+
+        def submit(level, directory):
+            pending[pool.submit(self.cache.get, level, directory)] = (level, directory)
+
+        submit(0, path)
+        try:
+            while pending and len(found) < len(wanted):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    level, directory = pending.pop(future)
+                    listing = future.result()
+                    if level + 1 < len(_LEVELS):
+                        for child in listing:
+                            submit(level + 1, child)
+                        continue
+                    for name in wanted.intersection(listing):
+                        found.setdefault(name, os.path.join(directory, "Samples", name))
+        finally:
+            for future in pending:
+                future.cancel()
+
+        return {pseudonym: found.get(pseudonym) for pseudonym in pseudonyms}
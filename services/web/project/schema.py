@@ -0,0 +1,82 @@
+from sqlalchemy import inspect
+
+from .app import db
+
+
+class DuplicateKeysError(Exception):
+    """Raised when a unique index cannot be created because the table holds duplicate keys"""
+
+
+def _surplus_rows(table, column):
+    """Number of rows that repeat an already present value of column"""
+    return db.session.execute(
+        db.select(db.func.count(column) - db.func.count(db.distinct(column))).select_from(table)
+    ).scalar_one()
+
+
+def _remove_duplicates(table, column):
+    """Deletes rows repeating a value of column, keeping the oldest (lowest id) one
+
+    NULLs never collide in a unique index, rows without a value are kept.
+    """
+    keep = db.select(db.func.min(table.c.id)).where(column.is_not(None)).group_by(column)
+    return db.session.execute(
+        db.delete(table).where(column.is_not(None), table.c.id.not_in(keep))).rowcount
+
+
+def _add_column(table, column):
+    column_type = column.type.compile(dialect=db.engine.dialect)
+    db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def migrate_schema(dedupe=False):
+    """Brings an existing database up to the models without dropping any data
+
+    Creates missing tables, adds missing (nullable) columns and creates missing indexes.
+    A unique index cannot be created over duplicate keys: those are removed with dedupe
+    (keeping the oldest row), otherwise DuplicateKeysError is raised.
+
+    Parameters
+    ----------
+    dedupe : bool
+        Whether to delete duplicate rows blocking a unique index
+
+    Returns
+    -------
+    list of str
+        Performed changes, empty when the schema was up to date
+    """
+    changes = []
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    db.create_all()
+    changes.extend(f"created table {table.name}" for table in db.metadata.sorted_tables
+                   if table.name not in existing_tables)
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                _add_column(table, column)
+                changes.append(f"added column {table.name}.{column.name}")
+
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.unique:
+                for column in index.columns:
+                    surplus = _surplus_rows(table, column)
+                    if surplus and not dedupe:
+                        raise DuplicateKeysError(f"{table.name}.{column.name} has {surplus} duplicate rows, "
+                                                 f"remove them or migrate with dedupe")
+                    if surplus:
+                        changes.append(f"removed {_remove_duplicates(table, column)} duplicate rows "
+                                       f"of {table.name}.{column.name}")
+            index.create(db.session.connection())
+            changes.append(f"created index {index.name}")
+
+    db.session.commit()
+    return changes
@@ -0,0 +1,40 @@
+import json
+import secrets
+
+
+class SearchResultStore:
+    """Results of pathology searches kept in Redis under a short search ID
+
+    The retrieval endpoints get the search ID instead of the whole result, so the session cookie
+    stays small however many samples a search finds. Results expire after ttl_seconds.
+
+    Parameters
+    ----------
+    redis_client : redis.Redis
+        Client decoding responses
+    ttl_seconds : int
+        Lifetime of a stored result
+    prefix : str
+        Prefix of the Redis keys
+    """
+
+    def __init__(self, redis_client, ttl_seconds=86400, prefix="search"):
+        self.redis = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _key(self, search_id):
+        return f"{self.prefix}:{search_id}"
+
+    def save(self, result):
+        """Stores a JSON serializable result and returns its new search ID"""
+        search_id = secrets.token_urlsafe(9)
+        self.redis.set(self._key(search_id), json.dumps(result), ex=self.ttl_seconds)
+        return search_id
+
+    def load(self, search_id):
+        """The stored result, None for unknown or expired search IDs"""
+        if not search_id:
+            return None
+        data = self.redis.get(self._key(search_id))
+        return json.loads(data) if data is not None else None
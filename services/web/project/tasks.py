@@ -1,32 +1,180 @@
 from .redis_client import redis_client
-from .utils import threaded_copy
+from .utils import plan_copy, remove_expired_entries, remove_stale_stagings, threaded_copy
+from .copy_engine import CopyStats
+from .job_events import CopyProgress, publish_job_event
+from .job_registry import RetrievalLease, claim_destinations, in_flight_job, release_destinations, storage_key
+from .metrics import RENAME_SECONDS, observe_copy
 from .celery_app import celery
+from .run_index import refresh_run_index
+from .bbm import enrich_file
+from celery.exceptions import Retry
+from flask import current_app
 from typing import Dict, List, Any
+import os
+import time
 
 
-@celery.task
-def copy_multiple_runs_task(runs_data: Dict[str, Dict[str, Any]], job_id: str):
+def _copy_jobs(task, job_id, jobs, destinations, link_mode="copy"):
+    """Plans every (label, src, dest, pseudonym, pred_num, full_run) copy of a job first, so the
+    progress events know the job totals, then copies them one after another
+
+    destinations are the final paths of the jobs, in the same order. At most
+    RETRIEVAL_MAX_PARALLEL_COPIES jobs copy from one storage at once, a job finding no free copy
+    slot publishes "queued" and is retried after RETRIEVAL_SLOT_POLL_SECONDS, so it does not keep
+    a worker busy meanwhile. Once copying, the claims of the job on destinations (see
+    claim_destinations) and its copy slot are a RetrievalLease renewed while the job runs and
+    released when it ends.
+    """
+    config = current_app.config
+    lease = None
+    try:
+        storage = storage_key(jobs[0][1])
+        # while queued the claims last as long as those of the request, a retry may wait in the broker;
+        # a retried (or redelivered) task skips what another job took over or published meanwhile
+        holders = claim_destinations(job_id, destinations, config["RETRIEVAL_CLAIM_TTL_SECONDS"])
+        kept = [(job, dest) for job, dest in zip(jobs, destinations)
+                if holders[dest] == job_id and not os.path.exists(dest)]
+        release_destinations(job_id, sorted(set(destinations) - {dest for _, dest in kept}))
+        jobs = [job for job, _ in kept]
+        lease = RetrievalLease(job_id, [dest for _, dest in kept], storage, config["RETRIEVAL_LEASE_SECONDS"],
+                               config["RETRIEVAL_MAX_PARALLEL_COPIES"])
+        if jobs and not lease.acquire_slot():
+            publish_job_event(job_id, "queued")
+            raise task.retry(countdown=config["RETRIEVAL_SLOT_POLL_SECONDS"], max_retries=None)
+        # from now on the claims expire soon unless the copy renews them
+        lease.claim()
+
+        with RENAME_SECONDS.time():
+            plans = [plan_copy(src, dest, pseudonym, pred_num, full_run)
+                     for _, src, dest, pseudonym, pred_num, full_run in jobs]
+        progress = CopyProgress(job_id,
+                                files_total=sum(len(plan.file_pairs) for plan in plans),
+                                bytes_total=sum(size for plan in plans for _, _, size, _ in plan.file_pairs),
+                                min_interval=config["JOB_PROGRESS_INTERVAL_SECONDS"],
+                                lease=lease)
+
+        stats = CopyStats()
+        for (label, src, dest, pseudonym, pred_num, full_run), plan in zip(jobs, plans):
+            progress.start(label)
+            stats.merge(threaded_copy(src, dest, pseudonym, pred_num, full_run, job_id,
+                                      config["COPY_WORKERS"], config["COPY_ZERO_COPY_MIN_BYTES"], plan, progress,
+                                      link_mode))
+        stats.stop()
+        observe_copy(stats, link_mode)
+    except Retry:
+        # queued, the claims stay with the job
+        raise
+    except Exception as e:
+        # ends the /job-status streams, which would wait for "finished" forever otherwise
+        publish_job_event(job_id, "failed", error=str(e))
+        if lease is not None:
+            lease.release()
+        # the claims of the request as well, when the job failed before leasing them
+        release_destinations(job_id, destinations)
+        raise
+
+    # released before the finished event, so a request attaching now already finds the data in place
+    lease.release()
+
+    summary = stats.serialize()
+    redis_client.hset(f"copy_stats:{job_id}", mapping=summary)
+    redis_client.expire(f"copy_stats:{job_id}", 7 * 24 * 3600)
+    print(f"Job {job_id} copied {summary['files']} files ({summary['bytes']} B) "
+          f"in {summary['duration_seconds']} s, {summary['throughput_mb_s']} MB/s, "
+          f"{summary['linked_files']} files linked ({link_mode})")
+    progress.finish(duration_seconds=summary["duration_seconds"], throughput_mb_s=summary["throughput_mb_s"])
+
+
+# Copies resume from their manifests, so a copy interrupted by a lost worker is simply delivered again
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def copy_multiple_runs_task(self, runs_data: Dict[str, Dict[str, Any]], job_id: str, link_mode: str = "copy"):
+    jobs = []
     for only_run, data in runs_data.items():
         run_path = data["run_path"]
         samples_pseudo = data["samples_pseudo"]
         samples_pred = data["samples_pred"]
 
         dest = f"/RETRIEVED/{only_run}"
-        threaded_copy(run_path, dest, samples_pseudo, samples_pred, True, job_id)
+        jobs.append((only_run, run_path, dest, samples_pseudo, samples_pred, True))
 
-    msg = f"Job {job_id} finished"
-    redis_client.publish(job_id, msg)
+    _copy_jobs(self, job_id, jobs, [dest for _, _, dest, _, _, _ in jobs], link_mode)
 
 
-@celery.task
-def copy_multiple_samples_task(samples: List[Dict[str, Any]], job_id: str):
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def copy_multiple_samples_task(self, samples: List[Dict[str, Any]], job_id: str, link_mode: str = "copy"):
+    jobs = []
     for i, sample in enumerate(samples, start=1):
         src = sample["path"]
         dest = f"/RETRIEVED/{sample['pseudonym']}"
         pseudonym = sample["pseudonym"]
         pred_num = sample["pred_number"]
 
-        threaded_copy(src, dest, pseudonym, pred_num, False, job_id)
+        jobs.append((pred_num, src, dest, pseudonym, pred_num, False))
+
+    # the sample folder is renamed to its predictive number while copied
+    _copy_jobs(self, job_id, jobs, [f"/RETRIEVED/{sample['pred_number']}" for sample in samples], link_mode)
+
+
+@celery.task
+def enrich_bbm_file_task(data_file_path: str, job_id: str):
+    download_folder = os.path.join(current_app.config["DOWNLOAD_FOLDER"], job_id)
+    os.makedirs(download_folder, exist_ok=True)
+
+    def publish_progress(rows_done):
+        publish_job_event(job_id, "progress", rows_done=rows_done)
+
+    try:
+        download_file_name = enrich_file(data_file_path, download_folder,
+                                         current_app.config["BBM_CHUNK_ROWS"],
+                                         current_app.config["SAMPLE_LOOKUP_CHUNK_SIZE"],
+                                         publish_progress)
+    except Exception as e:
+        # the processing page would wait forever otherwise
+        publish_job_event(job_id, "failed", error=str(e))
+        raise
+    redis_client.set(f"bbm_download:{job_id}", download_file_name, ex=current_app.config["BBM_DOWNLOAD_TTL_SECONDS"])
+    # the enriched copy is all that is needed from now on
+    os.remove(data_file_path)
+
+    publish_job_event(job_id, "finished", download_url=f"/bbm-sequencing-download/{job_id}")
+
+
+@celery.task
+def refresh_run_index_task():
+    lock = redis_client.lock("run_index:refresh", timeout=3600, blocking=False)
+    if not lock.acquire():
+        print("Run index refresh already in progress, skipping")
+        return None
+
+    try:
+        config = current_app.config
+        stats = refresh_run_index(config["RUNS_FOLDER"], config["RUN_INDEX_SETTLE_SECONDS"],
+                                  sweep_passes=config["RUN_INDEX_SWEEP_SECONDS"] // config["RUN_INDEX_REFRESH_SECONDS"],
+                                  pass_number=int(time.time() // config["RUN_INDEX_REFRESH_SECONDS"]))
+    finally:
+        lock.release()
 
-    msg = f"Job {job_id} finished"
-    redis_client.publish(job_id, msg)
+    stats["finished_at"] = time.time()
+    redis_client.hset("run_index:last_refresh", mapping=stats)
+    print(f"Run index refreshed: {stats}")
+    return stats
+
+
+@celery.task
+def remove_stale_stagings_task():
+    removed = remove_stale_stagings("/RETRIEVED", current_app.config["RETRIEVAL_STAGING_MAX_AGE_SECONDS"],
+                                    lambda dest: in_flight_job(dest) is not None)
+    if removed:
+        print(f"Removed abandoned staging directories: {removed}")
+    return removed
+
+
+@celery.task
+def remove_expired_bbm_files_task():
+    """Removes enriched files whose download expired, and uploads left behind by failed enrichments"""
+    max_age_seconds = current_app.config["BBM_DOWNLOAD_TTL_SECONDS"]
+    removed = (remove_expired_entries(current_app.config["DOWNLOAD_FOLDER"], max_age_seconds)
+               + remove_expired_entries(current_app.config["UPLOAD_FOLDER"], max_age_seconds))
+    if removed:
+        print(f"Removed expired BBM files: {removed}")
+    return removed
@@ -1,83 +1,263 @@
+import hashlib
 import os
 import shutil
+import time
 
+from .copy_engine import CopyManifest, copy_files
+from .rewrite import PseudonymRewriter
 
-def threaded_copy(src, dest, pseudonym, pred_num, full_run, job_id):
-    if full_run:
-        shutil.copytree(src, dest, ignore=shutil.ignore_patterns('FASTQ'))
+STAGING_DIR = ".staging"
+# run metadata files listing all samples of the run
+_RUN_METADATA_FILES = {"SampleSheet.csv", os.path.join("Alignment", "AdapterCounts.txt")}
 
-        # group all FASTQ files from Samples together into one FASTQ folder
-        dest_fastq = os.path.join(dest, 'FASTQ')
-        os.makedirs(dest_fastq, exist_ok=True)
-        samples_path = os.path.join(src, 'Samples')
 
-        for sample_dir in os.listdir(samples_path):
-            fastq_dir = os.path.join(samples_path, sample_dir, 'FASTQ')
-            if os.path.isdir(fastq_dir):
-                for filename in os.listdir(fastq_dir):
-                    src_file = os.path.join(fastq_dir, filename)
-                    dest_file = os.path.join(dest_fastq, filename)
-                    shutil.copy2(src_file, dest_file)
-        _rename_whole_run(dest, pseudonym, pred_num)
-    else:
-        shutil.copytree(src, dest)
-        _rename_files_recursively(pseudonym, pred_num, dest)
+class CopyPlan:
+    """Files of one retrieved run or sample that still have to be copied into its staging directory
 
+    Every file is planned under its final, de-pseudonymized name. Retrievals are copied into
+    <dest parent>/.staging/<hash of dest>/ and moved to dest only when complete, so a partial
+    copy is never visible under dest.
+    """
+
+    def __init__(self, dest, rewriter):
+        self.dest = dest
+        self.rewriter = rewriter
+        staging_key = hashlib.sha1(dest.encode()).hexdigest()[:16]
+        self.staging_root = os.path.join(os.path.dirname(dest), STAGING_DIR, staging_key)
+        self.tree = os.path.join(self.staging_root, os.path.basename(dest))
+
+        self.manifest = CopyManifest(self.staging_root)
+        if self.manifest.stale:
+            shutil.rmtree(self.staging_root)
+            self.manifest = CopyManifest(self.staging_root)
+        os.makedirs(self.tree, exist_ok=True)
 
-def _rename_whole_run(path, samples_pseudo, samples_pred):
-    _replace_file_inside_multiple(os.path.join(path, "Alignment", "AdapterCounts.txt"), samples_pseudo, samples_pred)
-    _replace_file_inside_multiple(os.path.join(path, "SampleSheet.csv"), samples_pseudo, samples_pred)
-    for pseudo, pred in zip(samples_pseudo, samples_pred):
-        _rename_files_recursively(pseudo, pred, os.path.join(path, "Samples"))
-        _rename_files_recursively(pseudo, pred, os.path.join(path, "FASTQ"))
+        self.dir_pairs = []
+        self.file_pairs = []
+        self.mtimes = {}
+        self.resumed_files = 0
+        self._planned = set()
 
+    def _claim(self, src, dest):
+        if dest in self._planned:
+            raise FileExistsError(f"Retrieving {src} as {dest} collides with another retrieved file")
+        self._planned.add(dest)
 
-def _replace_file_inside(file_name, text_to_replace, replaced_text):
-    if not os.path.exists(file_name):
-        return
+    def add_dir(self, src_dir, dest_dir):
+        self._claim(src_dir, dest_dir)
+        os.makedirs(dest_dir, exist_ok=True)
+        self.dir_pairs.append((src_dir, dest_dir))
 
-    with open(file_name, "rb") as f:
-        data = f.read()
+    def add_file(self, src_file, dest_file, rewrite=False):
+        self._claim(src_file, dest_file)
+        st = os.stat(src_file)
+        if self.manifest.is_copied(src_file, dest_file, st.st_size, st.st_mtime_ns):
+            self.resumed_files += 1
+            return
+        self.file_pairs.append((src_file, dest_file, st.st_size, self.rewriter if rewrite else None))
+        self.mtimes[dest_file] = st.st_mtime_ns
 
-    with open(file_name, "wb") as f:
-        data = data.replace(str.encode(text_to_replace), str.encode(replaced_text))
-        f.write(data)
+    def copied(self, src_file, dest_file, size):
+        self.manifest.record(src_file, dest_file, size, self.mtimes[dest_file])
 
 
-def _replace_file_inside_multiple(file_name, texts_to_replace, replaced_texts):
-    if not os.path.exists(file_name):
-        return
+def _plan_tree_copy(plan, src, dest, skip=(), exclude=(), rename=False, rewritten_files=()):
+    """Plans the copy of the src tree into dest
+
+    Names in skip are left out at any depth, names in exclude only directly in src.
+    With rename, pseudonyms in names are replaced and _StatInfo files are rewritten,
+    files in rewritten_files (relative to src) are rewritten in any case.
+    """
+    name = plan.rewriter.rewrite_name if rename else str
+    for root, dirs, files in os.walk(src, followlinks=True):
+        dirs[:] = [d for d in dirs if d not in skip and not (root == src and d in exclude)]
+        rel_root = os.path.relpath(root, src)
+        dest_root = dest if rel_root == "." else os.path.join(dest, *map(name, rel_root.split(os.sep)))
+        plan.add_dir(root, dest_root)
+        for f in files:
+            if f not in skip:
+                rewrite = (rename and "_StatInfo" in f) or os.path.normpath(os.path.join(rel_root, f)) in rewritten_files
+                plan.add_file(os.path.join(root, f), os.path.join(dest_root, name(f)), rewrite)
 
-    with open(file_name, "r") as f:
-        data = f.read()
 
-    for rep, new in zip(texts_to_replace, replaced_texts):
-        data = data.replace(rep, new)
+def _copy_dir_stats(dir_pairs):
+    # children first, so copying files into a directory does not change its mtime again
+    for src_dir, dest_dir in reversed(dir_pairs):
+        shutil.copystat(src_dir, dest_dir)
 
-    with open(file_name, "w") as f:
-        f.write(data)
 
+def plan_copy(src, dest, pseudonym, pred_num, full_run):
+    """Creates the directory skeleton of a retrieved run or sample in its staging directory and lists
+    the files to copy, leaving out files a previous interrupted attempt already copied
 
-def _rename_files_recursively(text_to_replace, replaced_text, current_file):
-    """Recursively renames all files ina run that contain predictive number with
-    pseudonymized predictive number. Does it in a way to not create conflicts in a renaming
+    Files are planned under their final names: pseudonyms are replaced in names inside Samples and
+    FASTQ (in the whole tree and dest itself for a single sample), and SampleSheet.csv,
+    Alignment/AdapterCounts.txt and _StatInfo files are rewritten while copied.
 
     Parameters
     ----------
-    text_to_replace : str
-        Text that should be replaced in a file name
-    replaced_text : str
-        Text that will replace "text_to_replace" in a file name
-    current_file : str
-        Path of a current directory that will be renamed and then listed to rename inner file
+    src : str
+        Run or sample folder in /RUNS
+    dest : str
+        Pseudonymized destination, the sample folder is renamed to the predictive number
+    pseudonym : str or list of str
+        Pseudonym of the sample, or pseudonyms of all samples of the run
+    pred_num : str or list of str
+        Predictive number(s) matching pseudonym
+    full_run : bool
+        Whether src is a whole run or a single sample
+
+    Returns
+    -------
+    CopyPlan
     """
-    current_file_renamed = current_file.replace(text_to_replace, replaced_text, 1)
-    os.rename(current_file, current_file_renamed)
-    for file in os.listdir(current_file_renamed):
-        file_path = os.path.join(current_file_renamed, file)
-        if os.path.isdir(file_path):
-            _rename_files_recursively(text_to_replace, replaced_text, file_path)
+    rewriter = PseudonymRewriter(dict(zip(pseudonym, pred_num)) if full_run else {pseudonym: pred_num})
+    if not full_run:
+        plan = CopyPlan(os.path.join(os.path.dirname(dest), rewriter.rewrite_name(os.path.basename(dest))), rewriter)
+        _plan_tree_copy(plan, src, plan.tree, rename=True)
+        return plan
+
+    plan = CopyPlan(dest, rewriter)
+    _plan_tree_copy(plan, src, plan.tree, skip=("FASTQ",), exclude=("Samples",), rewritten_files=_RUN_METADATA_FILES)
+    samples_path = os.path.join(src, 'Samples')
+    _plan_tree_copy(plan, samples_path, os.path.join(plan.tree, 'Samples'), skip=("FASTQ",), rename=True)
+
+    # group all FASTQ files from Samples together into one FASTQ folder
+    dest_fastq = os.path.join(plan.tree, 'FASTQ')
+    os.makedirs(dest_fastq, exist_ok=True)
+
+    for sample_dir in os.listdir(samples_path):
+        fastq_dir = os.path.join(samples_path, sample_dir, 'FASTQ')
+        if os.path.isdir(fastq_dir):
+            for filename in os.listdir(fastq_dir):
+                plan.add_file(os.path.join(fastq_dir, filename), os.path.join(dest_fastq, rewriter.rewrite_name(filename)),
+                              "_StatInfo" in filename)
+
+    return plan
+
+
+def _remove_if_empty(directory):
+    try:
+        os.rmdir(directory)
+    except OSError:
+        # other retrievals are staged there, or it is gone already
+        pass
+
+
+def _publish_staged(plan):
+    """Moves the finished tree from staging to its final place"""
+    os.rename(plan.tree, plan.dest)
+    shutil.rmtree(plan.staging_root)
+    _remove_if_empty(os.path.dirname(plan.staging_root))
+    return plan.dest
+
+
+def _last_activity(staging_root):
+    """Newest mtime of the staging directory and its manifest, which is rewritten while files are copied"""
+    mtimes = []
+    for path in (staging_root, os.path.join(staging_root, CopyManifest.FILE_NAME)):
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            pass
+    return max(mtimes, default=0.0)
+
+
+def remove_stale_stagings(retrieved_root, max_age_seconds, is_active):
+    """Removes the staging directories of retrievals abandoned more than max_age_seconds ago
+
+    Parameters
+    ----------
+    retrieved_root : str
+        Folder the retrievals are published to
+    max_age_seconds : float
+        Age of the last copied file after which an inactive staging directory is removed
+    is_active : callable
+        Called with the final path of a staged retrieval, True while a job is retrieving it
+
+    Returns
+    -------
+    list of str
+        Removed staging directories
+    """
+    staging_parent = os.path.join(retrieved_root, STAGING_DIR)
+    try:
+        staging_keys = os.listdir(staging_parent)
+    except FileNotFoundError:
+        return []
+
+    removed = []
+    now = time.time()
+    for staging_key in staging_keys:
+        staging_root = os.path.join(staging_parent, staging_key)
+        if now - _last_activity(staging_root) < max_age_seconds:
+            continue
+        # the staged tree has the name of its destination, next to the manifest
+        staged = [name for name in os.listdir(staging_root) if not name.startswith(CopyManifest.FILE_NAME)]
+        if any(is_active(os.path.join(retrieved_root, name)) for name in staged):
+            continue
+        shutil.rmtree(staging_root, ignore_errors=True)
+        removed.append(staging_root)
+    _remove_if_empty(staging_parent)
+    return removed
+
+
+def remove_expired_entries(folder, max_age_seconds):
+    """Removes the files and job folders of folder not modified for max_age_seconds
+
+    A job folder counts as modified when any file directly in it was, its content is written after
+    the folder is created.
+
+    Returns
+    -------
+    list of str
+        Removed files and folders
+    """
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return []
+
+    removed = []
+    now = time.time()
+    for entry in entries:
+        try:
+            mtime = entry.stat().st_mtime
+            if entry.is_dir(follow_symlinks=False):
+                mtime = max([mtime] + [child.stat().st_mtime for child in os.scandir(entry.path)])
+        except FileNotFoundError:
+            continue
+        if now - mtime < max_age_seconds:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
         else:
-            if "_StatInfo" in file:
-                _replace_file_inside(os.path.join(current_file_renamed, file), text_to_replace, replaced_text)
-            os.rename(os.path.join(current_file_renamed, file), os.path.join(current_file_renamed, file.replace(text_to_replace, replaced_text)))
+            os.remove(entry.path)
+        removed.append(entry.path)
+    return removed
+
+
+def threaded_copy(src, dest, pseudonym, pred_num, full_run, job_id, workers=8, zero_copy_min_bytes=16 * 1024 * 1024,
+                  plan=None, progress=None, link_mode="copy"):
+    """Copies a run or sample from /RUNS to dest, replacing pseudonyms with predictive numbers on the way
+
+    pseudonym and pred_num are lists of all samples of the run for full_run, single values otherwise.
+    link_mode "reflink" or "hardlink" links large files that are not rewritten instead of copying them.
+    Returns the CopyStats of the copy.
+    """
+    plan = plan if plan is not None else plan_copy(src, dest, pseudonym, pred_num, full_run)
+
+    def on_copied(src_file, dest_file, size):
+        plan.copied(src_file, dest_file, size)
+        if progress is not None:
+            progress.copied(src_file, dest_file, size)
+
+    try:
+        stats = copy_files(plan.file_pairs, workers, zero_copy_min_bytes, on_copied, link_mode,
+                           progress.heartbeat if progress is not None else None)
+    finally:
+        plan.manifest.flush()
+    _copy_dir_stats(plan.dir_pairs)
+    _publish_staged(plan)
+
+    return stats
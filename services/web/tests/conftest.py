@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the tests never connect, the app only needs a database URL it can create an engine for
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
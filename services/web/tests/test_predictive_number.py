@@ -0,0 +1,65 @@
+import re
+
+from hypothesis import assume, given, strategies as st
+
+from project.predictive_number import normalize, normalize_many
+
+
+def modify_predictive_number(pred_number):
+    """The regex chain normalize replaced, its unified form must not change"""
+    if re.match(r"^20[1-2][\d]-[\d]{1,4}", pred_number):
+        year, id = pred_number.split("-", 1)
+        return f"{year}_{id}"
+    if re.match(r"^[1-2][\d]\-[\d]{1,4}", pred_number):
+        year, id = pred_number.split("-", 1)
+        return f"20{year}_{id}"
+    if re.match(r"^[\d]{1,4}\-[1-2][\d]", pred_number):
+        id, year = pred_number.split("-", 1)
+        return f"20{year}_{id}"
+    if re.match(r"^[1-2][\d]_[\d]{1,4}", pred_number):
+        year, id = pred_number.split("_", 1)
+        return f"20{year}_{id}"
+    return pred_number
+
+
+years = st.integers(2010, 2029).map(str)
+numbers = st.text(alphabet="0123456789", min_size=1, max_size=6)
+# anything not starting with a digit, which would belong to the number (or year) before it
+_SUFFIX_START = "ABDINRr_/ -"
+suffixes = st.sampled_from(["", "_RNA", "_DNA", "A", "II", "r"]) | st.builds(
+    str.__add__, st.sampled_from(_SUFFIX_START), st.text(alphabet=_SUFFIX_START + "0123456789", max_size=6))
+layouts = st.sampled_from(["{year}-{number}{suffix}", "{yy}-{number}{suffix}", "{number}-{yy}{suffix}",
+                           "{yy}_{number}{suffix}", "{year}_{number}{suffix}"])
+# the characters predictive numbers are made of, in any order
+raw_values = st.text(alphabet="0123456789-_/ABIRNDr \n", max_size=14)
+
+
+@st.composite
+def formatted(draw):
+    year = draw(years)
+    return draw(layouts).format(year=year, yy=year[2:], number=draw(numbers), suffix=draw(suffixes))
+
+
+@given(raw_values | formatted())
+def test_unified_matches_legacy(value):
+    assert normalize(value).unified == modify_predictive_number(value)
+
+
+@given(years, numbers, suffixes, layouts)
+def test_split_into_base_suffix_and_year(year, number, suffix, layout):
+    value = layout.format(year=year, yy=year[2:], number=number, suffix=suffix)
+    if layout.startswith("{number}"):
+        # numbers first have at most 4 digits, 12-22 and 2021-22 are read year first
+        assume(len(number) <= 4 and not re.fullmatch(r"[1-2]\d|20[1-2]\d", number))
+    predictive = normalize(value)
+    assert (predictive.year, predictive.number, predictive.suffix) == (int(year), number, suffix)
+    assert predictive.index_columns == {
+        "predictive_base": f"{year}_{number}",
+        "predictive_suffix": suffix.lstrip("_"),
+        "predictive_year": int(year),
+    }
+
+
+@given(st.lists(raw_values | formatted()))
+def test_normalize_many_matches_normalize(values):
+    assert normalize_many(values) == [normalize(value) for value in values]